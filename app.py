@@ -5,14 +5,25 @@ Retrieval-Augmented Generation · UpToDate Knowledge Base · Anthropic Claude
 Architecture:
   Embeddings : sentence-transformers/all-MiniLM-L6-v2  (local, no API key)
   Generation : Anthropic Claude claude-3-5-haiku-20241022
-  Retrieval  : Cosine similarity (pure Python)
+  Retrieval  : Cosine similarity (FAISS inner-product index; numpy fallback)
 """
 
 import streamlit as st
-import json
 import re
+import hashlib
 import os
+import io
 import base64
+import copy
+import functools
+import logging
+import threading
+import traceback
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass, fields
+
+from rag_engine import cbc_json   # stdlib-only module; heavy engine deps load lazily
 
 # ─────────────────────────────────────────────────────────
 # PAGE CONFIG
@@ -27,7 +38,52 @@ st.set_page_config(
 # ─────────────────────────────────────────────────────────
 # PATHS & CONSTANTS
 # ─────────────────────────────────────────────────────────
-KB_PATH = os.path.join(os.path.dirname(__file__), "data", "cbc_knowledge_base.json")
+KB_PATH  = os.path.join(os.path.dirname(__file__), "data", "cbc_knowledge_base.json")
+CSS_PATH = os.path.join(os.path.dirname(__file__), "assets", "style.css")
+
+# Manual-entry grid rows: (key, series, parameter, unit, max accepted value)
+PARAM_SPEC = (
+    ("rbc",           "🔴 RBC",      "RBC",                   "×10¹²/L", 15.0),
+    ("hgb",           "🔴 RBC",      "Hemoglobin",            "g/dL",    25.0),
+    ("hct",           "🔴 RBC",      "Hematocrit",            "%",       75.0),
+    ("mcv",           "🔴 RBC",      "MCV",                   "fL",      200.0),
+    ("mch",           "🔴 RBC",      "MCH",                   "pg",      60.0),
+    ("mchc",          "🔴 RBC",      "MCHC",                  "g/dL",    50.0),
+    ("rdw",           "🔴 RBC",      "RDW",                   "%",       30.0),
+    ("retic",         "🔴 RBC",      "Reticulocytes",         "%",       20.0),
+    ("wbc",           "⚪ WBC",      "WBC",                   "×10⁹/L",  500.0),
+    ("neut_abs",      "⚪ WBC",      "Neutrophils Abs",       "×10⁹/L",  300.0),
+    ("neut_pct",      "⚪ WBC",      "Neutrophils",           "%",       100.0),
+    ("lymph_abs",     "⚪ WBC",      "Lymphocytes Abs",       "×10⁹/L",  200.0),
+    ("lymph_pct",     "⚪ WBC",      "Lymphocytes",           "%",       100.0),
+    ("mono_abs",      "⚪ WBC",      "Monocytes Abs",         "×10⁹/L",  50.0),
+    ("eos_abs",       "⚪ WBC",      "Eosinophils Abs",       "×10⁹/L",  50.0),
+    ("baso_abs",      "⚪ WBC",      "Basophils Abs",         "×10⁹/L",  10.0),
+    ("bands",         "⚪ WBC",      "Bands",                 "%",       100.0),
+    ("plt",           "🟡 Platelet", "Platelets",             "×10⁹/L",  3000.0),
+    ("mpv",           "🟡 Platelet", "MPV",                   "fL",      30.0),
+    ("immature_gran", "🔬 Extended", "Immature Granulocytes", "%",       100.0),
+    ("nrbc",          "🔬 Extended", "Nucleated RBCs",        "%",       100.0),
+    ("mono_pct",      "🔬 Extended", "Monocytes",             "%",       100.0),
+    ("eos_pct",       "🔬 Extended", "Eosinophils",           "%",       100.0),
+    ("baso_pct",      "🔬 Extended", "Basophils",             "%",       100.0),
+)
+_PARAM_MAX = np.array([spec[4] for spec in PARAM_SPEC], dtype=float)
+
+# numba is optional: when installed, numeric rule kernels are JIT-compiled and
+# cached on disk (outside __pycache__, so container rebuilds keep the cache).
+os.environ.setdefault("NUMBA_CACHE_DIR", os.path.join(os.path.dirname(__file__), ".numba_cache"))
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return args[0] if args and callable(args[0]) else (lambda fn: fn)
+
+# pybase64 is optional: SIMD base64 for multi-MB report images, same API as stdlib.
+try:
+    import pybase64 as _b64
+except ImportError:
+    _b64 = base64
 
 REFERENCE_RANGES = {
     "rbc_m":     (4.5,  5.9,   "×10¹²/L"),
@@ -61,170 +117,230 @@ CRITICAL_RANGES = {
     "neut_abs": (0.5,  None),
 }
 
+# Sex-dependent bounds resolved once at import; main() picks THRESH[sex].
+THRESH = {
+    sx: {
+        "rbc_lo": REFERENCE_RANGES[f"rbc_{s}"][0], "rbc_hi": REFERENCE_RANGES[f"rbc_{s}"][1],
+        "hgb_lo": REFERENCE_RANGES[f"hgb_{s}"][0], "hgb_hi": REFERENCE_RANGES[f"hgb_{s}"][1],
+        "hct_lo": REFERENCE_RANGES[f"hct_{s}"][0], "hct_hi": REFERENCE_RANGES[f"hct_{s}"][1],
+        "hgb_crit": CRITICAL_RANGES[f"hgb_{s}"],
+    }
+    for sx, s in (("M", "m"), ("F", "f"))
+}
+
+# Parameter-review columns: (title, colour, rows of (label, CBC field, unit,
+# REFERENCE_RANGES key, CRITICAL_RANGES key)); "{s}" in a key is the sex suffix
+# and a None range key means "any non-zero value is abnormal".
+PARAM_REVIEW = (
+    ("RBC SERIES", "#f85149", (
+        ("RBC",           "rbc",   "×10¹²/L", "rbc_{s}", None),
+        ("Hemoglobin",    "hgb",   "g/dL",    "hgb_{s}", "hgb_{s}"),
+        ("Hematocrit",    "hct",   "%",       "hct_{s}", None),
+        ("MCV",           "mcv",   "fL",      "mcv",     None),
+        ("MCH",           "mch",   "pg",      "mch",     None),
+        ("MCHC",          "mchc",  "g/dL",    "mchc",    None),
+        ("RDW",           "rdw",   "%",       "rdw",     None),
+        ("Reticulocytes", "retic", "%",       "retic",   None),
+    )),
+    ("WBC SERIES", "#58a6ff", (
+        ("WBC",             "wbc",       "×10⁹/L", "wbc",       "wbc"),
+        ("Neutrophils Abs", "neut_abs",  "×10⁹/L", "neut_abs",  "neut_abs"),
+        ("Neutrophils %",   "neut_pct",  "%",      "neut_pct",  None),
+        ("Lymphocytes Abs", "lymph_abs", "×10⁹/L", "lymph_abs", None),
+        ("Lymphocytes %",   "lymph_pct", "%",      "lymph_pct", None),
+        ("Monocytes Abs",   "mono_abs",  "×10⁹/L", "mono_abs",  None),
+        ("Eosinophils Abs", "eos_abs",   "×10⁹/L", "eos_abs",   None),
+        ("Basophils Abs",   "baso_abs",  "×10⁹/L", "baso_abs",  None),
+    )),
+    ("PLATELET SERIES", "#d29922", (
+        ("Platelets",             "plt",           "×10⁹/L", "plt", "plt"),
+        ("MPV",                   "mpv",           "fL",     "mpv", None),
+        ("Immature Granulocytes", "immature_gran", "%",      None,  None),
+        ("Nucleated RBCs",        "nrbc",          "%",      None,  None),
+    )),
+)
+
+
+def _review_column(rows, s):
+    """Resolve one PARAM_REVIEW column for sex suffix s into parallel (SoA) arrays."""
+    labels, keys, units, bounds, crits = [], [], [], [], []
+    for label, key, unit, ref, crit in rows:
+        labels.append(label); keys.append(key); units.append(unit)
+        bounds.append(REFERENCE_RANGES[ref.format(s=s)][:2] if ref else (0, 0))
+        crits.append(CRITICAL_RANGES[crit.format(s=s)] if crit else (None, None))
+    return (
+        tuple(labels), tuple(keys), tuple(units), tuple(bounds),
+        np.array([b[0] for b in bounds], dtype=float),
+        np.array([b[1] for b in bounds], dtype=float),
+        np.array([c[0] or np.nan for c in crits], dtype=float),   # missing critical bound → NaN
+        np.array([c[1] or np.nan for c in crits], dtype=float),
+    )
+
+
+_REVIEW_ARR = {
+    sx: tuple(_review_column(rows, s) for _, _, rows in PARAM_REVIEW)
+    for sx, s in (("M", "m"), ("F", "f"))
+}
+
+# Abnormal-findings summary as parallel (SoA) arrays, built once at import.
+# Only Hemoglobin (row 0) has sex-specific bounds, hence one LO/HI row per sex.
+SUMMARY_KEYS  = ("hgb", "wbc", "plt", "mcv", "mchc", "rdw",
+                 "neut_abs", "lymph_abs", "eos_abs", "mpv", "retic")
+SUMMARY_NAMES = ("Hemoglobin", "WBC", "Platelets", "MCV", "MCHC", "RDW",
+                 "Neutrophils Abs", "Lymphocytes Abs", "Eosinophils Abs", "MPV", "Reticulocytes")
+SUMMARY_UNITS = ("g/dL", "×10⁹/L", "×10⁹/L", "fL", "g/dL", "%",
+                 "×10⁹/L", "×10⁹/L", "×10⁹/L", "fL", "%")
+SUMMARY_LO = {
+    "M": (13.5, 4.5, 150, 80, 32, 11.5, 1.8, 1.0, 0.0, 7.5, 0.5),
+    "F": (12.0, 4.5, 150, 80, 32, 11.5, 1.8, 1.0, 0.0, 7.5, 0.5),
+}
+SUMMARY_HI = {
+    "M": (17.5, 11.0, 400, 100, 36, 14.5, 7.7, 4.8, 0.5, 12.5, 2.5),
+    "F": (15.5, 11.0, 400, 100, 36, 14.5, 7.7, 4.8, 0.5, 12.5, 2.5),
+}
+_SUMMARY_LO_ARR = {sx: np.array(v, dtype=float) for sx, v in SUMMARY_LO.items()}
+_SUMMARY_HI_ARR = {sx: np.array(v, dtype=float) for sx, v in SUMMARY_HI.items()}
+
+# Keyword-fallback rule table; evaluated in one vectorised pass by keyword_terms().
+KEYWORD_RULES = (
+    # (param,     op,  threshold M, threshold F, search terms)
+    ("hgb",       "<", 13.5, 12.0, "anemia hemoglobin low"),
+    ("mcv",       "<", 80,   80,   "microcytic MCV low iron deficiency thalassemia"),
+    ("mcv",       ">", 100,  100,  "macrocytic B12 folate MDS"),
+    ("neut_abs",  ">", 7.7,  7.7,  "neutrophilia infection CML"),
+    ("neut_abs",  "<", 1.8,  1.8,  "neutropenia drug autoimmune congenital"),
+    ("plt",       "<", 150,  150,  "thrombocytopenia ITP platelet"),
+    ("lymph_abs", "<", 1.0,  1.0,  "lymphopenia immunodeficiency SCID"),
+)
+_KW_KEYS, _KW_OPS, _KW_THR_M, _KW_THR_F, _KW_TERMS = zip(*KEYWORD_RULES)
+_KW_IS_LT = np.array([op == "<" for op in _KW_OPS])
+_KW_THR   = {"M": np.array(_KW_THR_M, dtype=float), "F": np.array(_KW_THR_F, dtype=float)}
+
+# Result tab each RAG section streams into while analyze_many runs
+SECTION_TABS = {"anemia": 0, "neutrophil": 1, "platelets": 2, "immunodeficiency": 3, "polycythemia": 4}
+
+PDF_JPEG_QUALITY = 85
+PDF_RENDER_DPI   = 144   # 2× the 72-pt PDF grid: small report print stays legible to OCR
+PDF_SCAN_PAGES   = 5     # leading pages searched for the CBC table
+CBC_PAGE_KEYWORDS = ("hemoglobin", "haemoglobin", "hgb", "wbc", "platelet")
+
+# PDF text-layer parsing: a line matching a label (most specific first) gives
+# that field the number directly after the label, if it is in the grid's
+# range; otherwise scanning continues. Differential rows are split into
+# _pct / _abs by whether the line carries a "%".
+TEXT_LAYER_LABELS = tuple((key, re.compile(rx, re.I)) for key, rx in (
+    ("nrbc",          r"nucleated\s+r(?:ed\s+)?b(?:lood\s+)?c|\bnrbc"),
+    ("immature_gran", r"immature\s+gran|\big\b"),
+    ("retic",         r"retic"),
+    ("mchc",          r"\bmchc\b"),
+    ("mch",           r"\bmch\b"),
+    ("mcv",           r"\bmcv\b"),
+    ("mpv",           r"\bmpv\b"),
+    ("rdw",           r"\brdw(?![\s-]*sd)"),
+    ("hgb",           r"h(?:a)?emoglobin|\bhgb\b|\bhb\b(?![\s-]*(?:a1c|a2|f\b|electro))"),
+    ("hct",           r"h(?:a)?ematocrit|\bhct\b|\bpcv\b"),
+    ("rbc",           r"\brbc\b|red\s+(?:blood\s+)?cell\s+count"),
+    ("wbc",           r"\bwbc\b|white\s+(?:blood\s+)?cell\s+count|total\s+leu[ck]ocyte"),
+    ("plt",           r"platelet|\bplt\b"),
+    ("bands",         r"\bbands?\b"),
+    ("neut",          r"neutrophil|\bneut"),
+    ("lymph",         r"lymphocyte|\blymph"),
+    ("mono",          r"monocyte|\bmono"),
+    ("eos",           r"eosinophil|\beos"),
+    ("baso",          r"basophil|\bbaso"),
+))
+_DIFF_KEYS   = frozenset(("neut", "lymph", "mono", "eos", "baso"))
+# Lines about other haemoglobin tests (HbA1c, electrophoresis) never carry a CBC value
+_NOT_CBC_RE  = re.compile(r"a1c|glycated|electrophoresis|hplc", re.I)
+# First number after the label, unless it is part of a token like x10^9/L
+_VALUE_RE    = re.compile(r"[^\d]*?(?<![\w.^])(\d+(?:\.\d+)?)(?![\w.^*])")
+_UNIT_RE     = re.compile(r"\([^)]*\)")                                  # "(10^9/L)" after a label
+_G_PER_L_RE  = re.compile(r"g\s*/\s*l\b", re.I)                          # g/L, not g/dL
+_L_PER_L_RE  = re.compile(r"\bl\s*/\s*l\b", re.I)
+_PER_MM3_RE  = re.compile(r"cumm|/\s*mm\s*[3³]|cells\s*/", re.I)
+_THOUSAND_RE = re.compile(r"10\s*\^?\s*[3³]|thou|\bk\s*/", re.I)
+_PARAM_MAX_BY_KEY = {spec[0]: spec[4] for spec in PARAM_SPEC}
+TEXT_LAYER_REQUIRED = ("hgb", "wbc", "plt")   # skip Vision only when all were read
+
+_BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+
+
+@dataclass(slots=True, frozen=True)
+class CBC:
+    """One patient's CBC. Unentered parameters stay None. Frozen, so hashable (rule memoisation)."""
+    rbc:           float | None = None
+    hgb:           float | None = None
+    hct:           float | None = None
+    mcv:           float | None = None
+    mch:           float | None = None
+    mchc:          float | None = None
+    rdw:           float | None = None
+    retic:         float | None = None
+    wbc:           float | None = None
+    neut_abs:      float | None = None
+    neut_pct:      float | None = None
+    lymph_abs:     float | None = None
+    lymph_pct:     float | None = None
+    mono_abs:      float | None = None
+    mono_pct:      float | None = None
+    eos_abs:       float | None = None
+    eos_pct:       float | None = None
+    baso_abs:      float | None = None
+    baso_pct:      float | None = None
+    bands:         float | None = None
+    plt:           float | None = None
+    mpv:           float | None = None
+    immature_gran: float | None = None
+    nrbc:          float | None = None
+
+
+# Structured-output schema for Vision extraction: Claude is forced to answer
+# through this tool, so the reply arrives as parsed JSON (no regex scraping).
+CBC_FIELDS = tuple(f.name for f in fields(CBC))
+CBC_TOOL = {
+    "name":        "record_cbc_values",
+    "description": "Record the numeric CBC values read from the lab report.",
+    "input_schema": {
+        "type":       "object",
+        "properties": {k: {"type": ["number", "null"]} for k in CBC_FIELDS},
+        "required":   list(CBC_FIELDS),
+    },
+}
+
 # ─────────────────────────────────────────────────────────
 # GLOBAL CSS
 # ─────────────────────────────────────────────────────────
-st.markdown("""
-<style>
-  @import url('https://fonts.googleapis.com/css2?family=DM+Serif+Display:ital@0;1&family=DM+Sans:wght@300;400;500;600&display=swap');
-
-  :root {
-    --bg:#0d1117; --surface:#161b22; --border:#30363d;
-    --red:#f85149; --amber:#d29922; --green:#3fb950;
-    --blue:#58a6ff; --purple:#bc8cff; --text:#e6edf3;
-    --muted:#8b949e; --accent:#1f6feb;
-    --claude:#da7756;
-  }
-
-  html,body,.stApp{background:var(--bg);color:var(--text);font-family:'DM Sans',sans-serif}
-
-  /* ── Header ── */
-  .rag-header{
-    background:linear-gradient(135deg,#0d1117 0%,#1a1a2e 50%,#0d1117 100%);
-    border:1px solid var(--claude);border-radius:16px;
-    padding:28px 36px;margin-bottom:28px;position:relative;overflow:hidden;
-  }
-  .rag-header::before{
-    content:'';position:absolute;top:-50%;right:-20%;
-    width:500px;height:500px;
-    background:radial-gradient(circle,rgba(218,119,86,.08) 0%,transparent 60%);
-    pointer-events:none;
-  }
-  .rag-header h1{font-family:'DM Serif Display',serif;font-size:2.2rem;color:#fff;margin:0}
-  .rag-header .tagline{color:var(--claude);font-size:.9rem;margin-top:4px}
-  .rag-badge{
-    display:inline-flex;align-items:center;gap:6px;
-    background:rgba(218,119,86,.12);border:1px solid var(--claude);
-    color:var(--claude);padding:4px 12px;border-radius:20px;
-    font-size:.75rem;margin-right:8px;margin-top:10px;
-  }
-
-  /* ── Step labels ── */
-  .step-label{
-    display:flex;align-items:center;gap:10px;
-    font-size:.75rem;font-weight:600;letter-spacing:2px;
-    text-transform:uppercase;color:var(--claude);
-    margin:28px 0 12px;border-bottom:1px solid #21262d;padding-bottom:8px;
-  }
-  .step-num{
-    background:var(--claude);color:#fff;border-radius:50%;
-    width:22px;height:22px;display:flex;
-    align-items:center;justify-content:center;font-size:.7rem;font-weight:700;
-  }
-
-  /* ── Parameter cards ── */
-  .param-card{
-    background:var(--surface);border:1px solid var(--border);
-    border-radius:10px;padding:12px 16px;margin-bottom:8px;transition:all .15s;
-  }
-  .param-card:hover{border-color:var(--claude)}
-  .param-card.low {border-left:3px solid var(--red);  background:rgba(248,81,73,.06)}
-  .param-card.high{border-left:3px solid var(--amber);background:rgba(210,153,34,.06)}
-  .param-card.crit{border-left:3px solid var(--purple);background:rgba(188,140,255,.1);animation:pulse-b 2s infinite}
-  .param-card.ok  {border-left:3px solid var(--green)}
-  @keyframes pulse-b{0%,100%{border-color:var(--purple)}50%{border-color:#ff79c6}}
-  .param-value{font-size:1.6rem;font-weight:600;line-height:1;margin:4px 0 2px}
-  .param-name {font-size:.72rem;color:var(--muted);text-transform:uppercase;letter-spacing:1px}
-  .param-ref  {font-size:.7rem;color:var(--muted)}
-  .status-pill{display:inline-block;padding:1px 8px;border-radius:12px;font-size:.68rem;font-weight:600;margin-left:6px}
-  .pill-ok  {background:rgba(63,185,80,.2);color:#3fb950}
-  .pill-low {background:rgba(248,81,73,.2);color:#f85149}
-  .pill-high{background:rgba(210,153,34,.2);color:#d29922}
-  .pill-crit{background:rgba(188,140,255,.2);color:#bc8cff}
-
-  /* ── Alert boxes ── */
-  .alert{border-radius:8px;padding:12px 16px;margin:6px 0;font-size:.88rem;line-height:1.6}
-  .alert-r{background:rgba(248,81,73,.1); border:1px solid rgba(248,81,73,.4)}
-  .alert-a{background:rgba(210,153,34,.1);border:1px solid rgba(210,153,34,.4)}
-  .alert-g{background:rgba(63,185,80,.1); border:1px solid rgba(63,185,80,.4)}
-  .alert-b{background:rgba(88,166,255,.1);border:1px solid rgba(88,166,255,.4)}
-  .alert-p{background:rgba(188,140,255,.1);border:1px solid rgba(188,140,255,.4)}
-
-  /* ── RAG answer ── */
-  .rag-answer{
-    background:#0d1117;border:1px solid var(--claude);border-radius:12px;
-    padding:20px 24px;font-size:.9rem;line-height:1.8;color:#e6edf3;position:relative;
-  }
-  .rag-answer::before{
-    content:'◆ CLAUDE RAG ANALYSIS';font-size:.65rem;font-weight:700;letter-spacing:2px;
-    color:var(--claude);display:block;margin-bottom:12px;
-    border-bottom:1px solid #21262d;padding-bottom:8px;
-  }
-
-  /* ── Source cards ── */
-  .source-card{background:#21262d;border:1px solid #30363d;border-radius:8px;padding:10px 14px;margin:6px 0;font-size:.8rem}
-  .source-header{display:flex;justify-content:space-between;align-items:center;margin-bottom:4px}
-  .source-title{color:var(--claude);font-weight:600}
-  .source-score{color:var(--green);font-size:.72rem;font-weight:600}
-  .source-section{color:var(--muted);font-size:.7rem}
-  .source-preview{color:#8b949e;font-size:.75rem;line-height:1.5;margin-top:4px}
-
-  /* ── Quality meter ── */
-  .q-meter-bg{background:#21262d;border-radius:20px;height:10px;overflow:hidden;margin:6px 0}
-  .q-meter-fill{height:100%;border-radius:20px;transition:width .5s ease}
-
-  /* ── Upload zone ── */
-  .upload-zone{
-    background:rgba(218,119,86,.05);border:2px dashed var(--claude);
-    border-radius:12px;padding:28px;text-align:center;color:var(--claude);font-size:.9rem;margin:8px 0;
-  }
-
-  /* ── Inputs ── */
-  .stNumberInput input{
-    background:#161b22!important;border:1px solid #30363d!important;
-    color:#e6edf3!important;border-radius:8px!important;
-    font-size:1rem!important;font-weight:500!important;
-  }
-  .stNumberInput input:focus{border-color:var(--claude)!important}
-
-  /* ── Button ── */
-  .stButton>button{
-    background:linear-gradient(135deg,#da7756 0%,#b85a3a 100%)!important;
-    color:white!important;border:none!important;border-radius:10px!important;
-    font-weight:600!important;font-size:1rem!important;
-    padding:12px 32px!important;transition:all .2s!important;
-  }
-  .stButton>button:hover{transform:translateY(-1px);box-shadow:0 8px 24px rgba(218,119,86,.4)!important}
-
-  /* ── Tabs ── */
-  .stTabs [data-baseweb="tab-list"]{gap:2px;background:#161b22!important;border-radius:10px;padding:4px}
-  .stTabs [data-baseweb="tab"]     {border-radius:8px!important;color:#8b949e!important;font-size:.85rem!important}
-  .stTabs [aria-selected="true"]   {background:var(--claude)!important;color:#fff!important}
-
-  /* ── Sidebar ── */
-  section[data-testid="stSidebar"]{background:#161b22;border-right:1px solid #30363d}
-  section[data-testid="stSidebar"] *{color:#e6edf3!important}
-
-  /* ── Scrollbar ── */
-  ::-webkit-scrollbar{width:6px}
-  ::-webkit-scrollbar-track{background:#161b22}
-  ::-webkit-scrollbar-thumb{background:#30363d;border-radius:3px}
-
-  /* ── Index status bar ── */
-  .index-ready{
-    background:rgba(63,185,80,.1);border:1px solid rgba(63,185,80,.4);
-    border-radius:8px;padding:8px 14px;font-size:.8rem;color:#3fb950;margin:8px 0;
-  }
-  .index-building{
-    background:rgba(218,119,86,.1);border:1px solid rgba(218,119,86,.4);
-    border-radius:8px;padding:8px 14px;font-size:.8rem;color:var(--claude);margin:8px 0;
-  }
-
-  /* ── Footer ── */
-  .footer{
-    background:#161b22;border:1px solid #30363d;border-radius:10px;
-    padding:10px 18px;text-align:center;color:#8b949e;font-size:.75rem;margin-top:28px;
-  }
-</style>
-""", unsafe_allow_html=True)
+@st.cache_resource(show_spinner=False)
+def _style_block(path: str) -> str:
+    """
+    Read the global stylesheet once per server process and return it as a
+    minified <style> block — it is re-sent to the browser on every rerun.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        css = f.read()
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css).replace(";}", "}")
+    return f"<style>{css.strip()}</style>"
+
+
+st.markdown(_style_block(CSS_PATH), unsafe_allow_html=True)
 
 
 # ─────────────────────────────────────────────────────────
 # UTILITY HELPERS
 # ─────────────────────────────────────────────────────────
 
-def nz(v):
-    return v if v else None
+@st.cache_data(show_spinner=False)
+def _param_grid() -> pd.DataFrame:
+    """Empty manual-entry grid, one row per PARAM_SPEC entry."""
+    _, series, names, units, _ = zip(*PARAM_SPEC)
+    return pd.DataFrame({
+        "Series":    series,
+        "Parameter": names,
+        "Value":     [np.nan] * len(PARAM_SPEC),
+        "Unit":      units,
+    })
 
 
 def step_label(num, text):
@@ -234,28 +350,43 @@ def step_label(num, text):
     )
 
 
+# Integer status codes (returned by classify_value / classify_values) and the
+# per-status card styling: (pill class, card class, pill text, value colour).
+STATUS_OK, STATUS_LOW, STATUS_HIGH, STATUS_CRIT_LOW, STATUS_CRIT_HIGH, STATUS_UNKNOWN = range(6)
+_STATUS_LUT = (
+    ("pill-ok",   "ok",   "✓ Normal",   "#3fb950"),
+    ("pill-low",  "low",  "↓ Low",      "#f85149"),
+    ("pill-high", "high", "↑ High",     "#d29922"),
+    ("pill-crit", "crit", "⚠ Critical", "#bc8cff"),
+    ("pill-crit", "crit", "⚠ Critical", "#bc8cff"),
+    ("",          "",     "",           "#e6edf3"),
+)
+_ALERT_CLS = {"r": "alert-r", "a": "alert-a", "g": "alert-g", "b": "alert-b", "p": "alert-p"}
+
+
 def classify_value(value, lo, hi, crit_lo=None, crit_hi=None):
-    if value is None:               return "unknown"
-    if crit_lo and value < crit_lo: return "crit_low"
-    if crit_hi and value > crit_hi: return "crit_high"
-    if value < lo:                  return "low"
-    if value > hi:                  return "high"
-    return "ok"
+    if value is None:               return STATUS_UNKNOWN
+    if crit_lo and value < crit_lo: return STATUS_CRIT_LOW
+    if crit_hi and value > crit_hi: return STATUS_CRIT_HIGH
+    if value < lo:                  return STATUS_LOW
+    if value > hi:                  return STATUS_HIGH
+    return STATUS_OK
 
 
-def render_param_card(label, value, unit, lo, hi, crit_lo=None, crit_hi=None):
-    if value is None:
-        return
-    status    = classify_value(value, lo, hi, crit_lo, crit_hi)
-    pill_cls  = {"ok":"pill-ok","low":"pill-low","high":"pill-high",
-                 "crit_low":"pill-crit","crit_high":"pill-crit"}.get(status,"")
-    card_cls  = {"ok":"ok","low":"low","high":"high",
-                 "crit_low":"crit","crit_high":"crit"}.get(status,"")
-    pill_txt  = {"ok":"✓ Normal","low":"↓ Low","high":"↑ High",
-                 "crit_low":"⚠ Critical","crit_high":"⚠ Critical"}.get(status,"")
-    val_color = {"ok":"#3fb950","low":"#f85149","high":"#d29922",
-                 "crit_low":"#bc8cff","crit_high":"#bc8cff"}.get(status,"#e6edf3")
-    st.markdown(f"""
+def classify_values(values, lo, hi, crit_lo, crit_hi):
+    """
+    Vectorised classify_value over parallel float arrays. Missing values and
+    missing critical bounds are NaN, which never compares true.
+    Returns an int array of STATUS_* codes.
+    """
+    return np.select(
+        [values < crit_lo, values > crit_hi, values < lo, values > hi],
+        [STATUS_CRIT_LOW, STATUS_CRIT_HIGH, STATUS_LOW, STATUS_HIGH],
+        default=STATUS_OK,
+    )
+
+
+_CARD_TMPL = """
     <div class="param-card {card_cls}">
       <div class="param-name">{label}</div>
       <div class="param-value" style="color:{val_color}">{value:.2f}
@@ -263,13 +394,55 @@ def render_param_card(label, value, unit, lo, hi, crit_lo=None, crit_hi=None):
         <span class="status-pill {pill_cls}">{pill_txt}</span>
       </div>
       <div class="param-ref">Ref: {lo}–{hi} {unit}</div>
-    </div>""", unsafe_allow_html=True)
+    </div>"""
+
+_SOURCE_TMPL = """
+                <div class="source-card">
+                  <div class="source-header">
+                    <div>
+                      <span class="source-title">[Source {index}] {title}</span><br>
+                      <span class="source-section">{section}</span>
+                    </div>
+                    <span class="source-score">Relevance: {pct}%</span>
+                  </div>
+                  <div style="background:#161b22;border-radius:4px;height:4px;overflow:hidden;margin:4px 0">
+                    <div style="background:{color};height:100%;width:{pct}%"></div>
+                  </div>
+                  <div class="source-preview">{preview}</div>
+                </div>"""
+
+
+def render_param_card(label, value, unit, lo, hi, crit_lo=None, crit_hi=None, status=None):
+    """Return the HTML for one parameter card ("" when the value was not entered)."""
+    if value is None:
+        return ""
+    if status is None:
+        status = classify_value(value, lo, hi, crit_lo, crit_hi)
+    pill_cls, card_cls, pill_txt, val_color = _STATUS_LUT[status]
+    return _CARD_TMPL.format(card_cls=card_cls, label=label, val_color=val_color, value=value,
+                             unit=unit, pill_cls=pill_cls, pill_txt=pill_txt, lo=lo, hi=hi)
+
+
+def render_param_column(cbc, column):
+    """
+    Render one precomputed _REVIEW_ARR column with a single st.markdown call:
+    the entered values are gathered into one array and classified in one pass.
+    """
+    labels, keys, units, bounds, lo, hi, crit_lo, crit_hi = column
+    values  = np.array([getattr(cbc, k) for k in keys], dtype=float)   # None → NaN
+    entered = np.flatnonzero(~np.isnan(values)).tolist()
+    if not entered:
+        return
+    codes = classify_values(values, lo, hi, crit_lo, crit_hi)
+    html  = "".join(render_param_card(labels[i], float(values[i]), units[i], *bounds[i],
+                                      status=int(codes[i]))
+                    for i in entered)
+    st.markdown(html, unsafe_allow_html=True)
 
 
 def render_alert(text, kind="b"):
-    text_html = re.sub(r'\*\*(.+?)\*\*', r'<strong style="color:#e6edf3">\1</strong>', text)
-    text_html = text_html.replace('\n', '<br>')
-    cls = {"r":"alert-r","a":"alert-a","g":"alert-g","b":"alert-b","p":"alert-p"}.get(kind,"alert-b")
+    text_html = _BOLD_RE.sub(r'<strong style="color:#e6edf3">\1</strong>', text).replace('\n', '<br>')
+    cls = _ALERT_CLS.get(kind, "alert-b")
     st.markdown(f'<div class="alert {cls}">{text_html}</div>', unsafe_allow_html=True)
 
 
@@ -281,56 +454,60 @@ def render_rag_answer(result: dict):
     st.markdown(f'<div class="rag-answer">{answer}</div>', unsafe_allow_html=True)
     if sources:
         with st.expander(f"📚 {len(sources)} Knowledge Sources Retrieved", expanded=False):
+            html = []
             for src in sources:
                 pct   = int(src["score"] * 100)
                 color = "#3fb950" if pct > 70 else ("#d29922" if pct > 50 else "#8b949e")
-                st.markdown(f"""
-                <div class="source-card">
-                  <div class="source-header">
-                    <div>
-                      <span class="source-title">[Source {src['index']}] {src['title']}</span><br>
-                      <span class="source-section">{src['section']}</span>
-                    </div>
-                    <span class="source-score">Relevance: {pct}%</span>
-                  </div>
-                  <div style="background:#161b22;border-radius:4px;height:4px;overflow:hidden;margin:4px 0">
-                    <div style="background:{color};height:100%;width:{pct}%"></div>
-                  </div>
-                  <div class="source-preview">{src['preview']}</div>
-                </div>""", unsafe_allow_html=True)
+                html.append(_SOURCE_TMPL.format(pct=pct, color=color, index=src["index"],
+                                                title=src["title"], section=src["section"],
+                                                preview=src["preview"]))
+            st.markdown("".join(html), unsafe_allow_html=True)
 
 
 # ─────────────────────────────────────────────────────────
 # SAMPLE QUALITY
 # ─────────────────────────────────────────────────────────
 
+@njit(cache=True)
+def _rot_kernel(rbc, hgb, hct):
+    """Relative deviations of Hgb from RBC×3 and HCT from Hgb×3 (-1.0 when not computable)."""
+    d_hgb = abs(hgb - rbc * 3) / (rbc * 3) if rbc > 0 and hgb != 0 else -1.0
+    d_hct = abs(hct - hgb * 3) / (hgb * 3) if hgb > 0 and hct != 0 else -1.0
+    return d_hgb, d_hct
+
+
+@st.cache_resource(show_spinner=False)
+def _warm_kernels():
+    """Compile (or load from NUMBA_CACHE_DIR) the rule kernels once per process."""
+    _rot_kernel(1.0, 3.0, 9.0)
+
+
 def rule_of_threes(rbc, hgb, hct):
     issues = []
-    if rbc and hgb:
-        exp = rbc * 3
-        if exp > 0 and abs(hgb - exp) / exp > 0.10:
-            issues.append(f"Hgb ({hgb:.1f}) deviates >{abs(hgb-exp)/exp*100:.0f}% from RBC×3 ({exp:.1f})")
-    if hgb and hct:
-        exp = hgb * 3
-        if exp > 0 and abs(hct - exp) / exp > 0.10:
-            issues.append(f"HCT ({hct:.1f}) deviates >{abs(hct-exp)/exp*100:.0f}% from Hgb×3 ({exp:.1f})")
+    d_hgb, d_hct = _rot_kernel(float(rbc or 0), float(hgb or 0), float(hct or 0))
+    if d_hgb > 0.10:
+        issues.append(f"Hgb ({hgb:.1f}) deviates >{d_hgb*100:.0f}% from RBC×3 ({rbc*3:.1f})")
+    if d_hct > 0.10:
+        issues.append(f"HCT ({hct:.1f}) deviates >{d_hct*100:.0f}% from Hgb×3 ({hgb*3:.1f})")
     return issues
 
 
-def sample_quality(data):
+@functools.lru_cache(maxsize=256)
+def sample_quality(cbc: CBC):
     issues = []; warnings = []; score = 100
-    for r in rule_of_threes(data.get("rbc"), data.get("hgb"), data.get("hct")):
+    for r in rule_of_threes(cbc.rbc, cbc.hgb, cbc.hct):
         issues.append(f"⚠ Rule-of-Threes: {r}"); score -= 20
-    mchc = data.get("mchc")
+    mchc = cbc.mchc
     if mchc and mchc > 36:
         issues.append("⚠ MCHC >36 g/dL — hemolysis, cold agglutinin, lipemia, or very high WBC"); score -= 15
     if mchc and mchc < 28:
         warnings.append("ℹ Very low MCHC — confirm no dilution or pre-analytical error")
-    plt = data.get("plt"); wbc = data.get("wbc")
+    plt = cbc.plt; wbc = cbc.wbc
     if plt and plt < 100 and wbc and wbc > 12:
         warnings.append("ℹ Low PLT + leukocytosis — consider pseudothrombocytopenia from platelet clumping")
     for k in ["rbc", "hgb", "hct", "wbc", "plt"]:
-        if data.get(k) is not None and data[k] <= 0:
+        v = getattr(cbc, k)
+        if v is not None and v <= 0:
             issues.append(f"⚠ {k.upper()} ≤ 0 — likely data entry error"); score -= 30
     return max(0, min(100, score)), issues, warnings
 
@@ -338,11 +515,14 @@ def sample_quality(data):
 # ─────────────────────────────────────────────────────────
 # BUILT-IN CLINICAL LOGIC  (no API required)
 # ─────────────────────────────────────────────────────────
-
-def built_in_anemia(data, sex):
-    hgb = data.get("hgb"); mcv = data.get("mcv"); rdw = data.get("rdw")
-    retic = data.get("retic"); hct = data.get("hct")
-    hgb_lo = 13.5 if sex == "M" else 12.0
+# Rules are pure functions of (CBC, sex) and memoised per process, so reruns
+# with unchanged inputs skip them. Callers must not mutate the returned lists.
+
+@functools.lru_cache(maxsize=256)
+def built_in_anemia(cbc: CBC, sex):
+    hgb = cbc.hgb; mcv = cbc.mcv; rdw = cbc.rdw
+    retic = cbc.retic; hct = cbc.hct
+    hgb_lo = THRESH[sex]["hgb_lo"]
     out = []
     if not hgb or hgb >= hgb_lo:
         if hgb: out.append(("g", "✅ No anemia detected"))
@@ -372,9 +552,10 @@ def built_in_anemia(data, sex):
     return out
 
 
-def built_in_neutrophil(data):
-    wbc = data.get("wbc"); neut_abs = data.get("neut_abs")
-    neut_pct = data.get("neut_pct"); bands = data.get("bands")
+@functools.lru_cache(maxsize=256)
+def built_in_neutrophil(cbc: CBC):
+    wbc = cbc.wbc; neut_abs = cbc.neut_abs
+    neut_pct = cbc.neut_pct; bands = cbc.bands
     anc = neut_abs or (wbc * neut_pct / 100 if wbc and neut_pct else None)
     out = []
     if anc is None: return out
@@ -396,8 +577,9 @@ def built_in_neutrophil(data):
     return out
 
 
-def built_in_platelets(data):
-    plt = data.get("plt"); mpv = data.get("mpv"); out = []
+@functools.lru_cache(maxsize=256)
+def built_in_platelets(cbc: CBC):
+    plt = cbc.plt; mpv = cbc.mpv; out = []
     if not plt: return out
     if plt < 150:
         out.append(("r", f"🔴 **Thrombocytopenia** — PLT {plt:.0f} ×10⁹/L"))
@@ -418,29 +600,189 @@ def built_in_platelets(data):
     return out
 
 
+def keyword_terms(cbc: CBC, sex: str) -> list:
+    """Search terms of every KEYWORD_RULES row this CBC triggers."""
+    vals = np.array([getattr(cbc, k) for k in _KW_KEYS], dtype=float)  # None → NaN
+    thr  = _KW_THR[sex]
+    hit  = np.where(_KW_IS_LT, vals < thr, vals > thr)
+    return [_KW_TERMS[i] for i in np.flatnonzero(hit)]
+
+
 # ─────────────────────────────────────────────────────────
 # PDF / IMAGE OCR via Claude Vision
 # ─────────────────────────────────────────────────────────
 
+def _is_cbc_page(text: str) -> bool:
+    text = text.lower()
+    return any(kw in text for kw in CBC_PAGE_KEYWORDS)
+
+
 def pdf_to_image_bytes(pdf_bytes):
+    """
+    Rasterises the CBC page of a PDF for Claude Vision as a JPEG (q85 — several
+    times smaller than PNG for scanned reports, with no measurable OCR loss).
+    The page is the first of the leading PDF_SCAN_PAGES whose text layer names a
+    CBC analyte (page 1 for scans without one); only that page is rendered.
+    Prefers pypdfium2 (thin PDFium binding, raster only); falls back to PyMuPDF.
+    Returns (image_bytes, mime_type), or (None, None) if neither library is installed.
+    """
+    scale = PDF_RENDER_DPI / 72
+
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        pdfium = None
+
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        try:
+            page = pdf[0]
+            for i in range(min(len(pdf), PDF_SCAN_PAGES)):
+                candidate = pdf[i]
+                textpage  = candidate.get_textpage()
+                try:
+                    found = _is_cbc_page(textpage.get_text_range())
+                finally:
+                    textpage.close()
+                if found:
+                    page = candidate
+                    break
+            image = page.render(scale=scale).to_pil().convert("RGB")
+        finally:
+            pdf.close()
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=PDF_JPEG_QUALITY)
+        return buf.getvalue(), "image/jpeg"
+
     try:
         import fitz
-        doc  = fitz.open(stream=pdf_bytes, filetype="pdf")
-        page = doc[0]
-        pix  = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        return pix.tobytes("png"), "image/png"
     except ImportError:
         return None, None
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        page = next((doc[i] for i in range(min(doc.page_count, PDF_SCAN_PAGES))
+                     if _is_cbc_page(doc[i].get_text("text"))), doc[0])
+        pix  = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+        return pix.tobytes("jpeg", jpg_quality=PDF_JPEG_QUALITY), "image/jpeg"
+    finally:
+        doc.close()
 
 
-def extract_cbc_with_claude(api_key: str, img_bytes: bytes, mime_type: str) -> dict:
+def _key_digest(api_key: str) -> str:
+    """Cache key for everything cached per API key, so the key itself is never hashed or stored as one."""
+    return hashlib.sha256(api_key.encode()).hexdigest() if api_key else ""
+
+
+def pdf_text_layer(pdf_bytes) -> str:
+    """Text of the leading PDF_SCAN_PAGES pages ("" for scans, or without a PDF library)."""
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        pdfium = None
+
+    texts = []
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        try:
+            for i in range(min(len(pdf), PDF_SCAN_PAGES)):
+                textpage = pdf[i].get_textpage()
+                try:
+                    texts.append(textpage.get_text_range())
+                finally:
+                    textpage.close()
+        finally:
+            pdf.close()
+        return "\n".join(texts)
+
+    try:
+        import fitz
+    except ImportError:
+        return ""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return "\n".join(doc[i].get_text("text") for i in range(min(doc.page_count, PDF_SCAN_PAGES)))
+    finally:
+        doc.close()
+
+
+def _text_unit_factor(key: str, rest: str):
     """
-    Uses Claude (claude-3-5-haiku) vision to extract CBC values from a lab report image.
+    Multiplier taking a value written in this line's unit to the grid's unit,
+    or None when the line uses a unit the grid can't take.
+    """
+    if "lakh" in rest.lower():
+        return 100.0 if key == "plt" else None            # 1 lakh/µL = 100 ×10⁹/L
+    if key in ("hgb", "mchc") and _G_PER_L_RE.search(rest):
+        return 0.1
+    if key == "hct" and _L_PER_L_RE.search(rest):
+        return 100.0
+    if _PER_MM3_RE.search(rest) and not _THOUSAND_RE.search(rest):
+        return None                                        # raw cells/mm³ counts
+    return 1.0
+
+
+def extract_cbc_from_text(text: str) -> dict:
+    """
+    Reads CBC values from report text with one labelled value per line.
+    Returns every CBC field, None where not found in the grid's unit and range.
+    """
+    out = dict.fromkeys(CBC_FIELDS)
+    for line in text.splitlines():
+        if _NOT_CBC_RE.search(line):
+            continue
+        for key, label_re in TEXT_LAYER_LABELS:
+            label = label_re.search(line)
+            if label is None:
+                continue
+            rest = line[label.end():]
+            if key in _DIFF_KEYS:
+                key = f"{key}_pct" if "%" in rest else f"{key}_abs"
+            num    = _VALUE_RE.match(_UNIT_RE.sub(" ", rest))
+            factor = _text_unit_factor(key, rest)
+            if num is not None and factor is not None and key in out and out[key] is None:
+                v = round(float(num.group(1)) * factor, 4)
+                if 0 < v <= _PARAM_MAX_BY_KEY[key]:
+                    out[key] = v
+            break   # one field per line
+    return out
+
+
+def text_layer_usable(values: dict) -> bool:
+    """
+    True when text-layer values can replace the Vision call: the core counts
+    were all read and the sample-quality checks (Rule of Threes, MCHC,
+    non-positive counts) raise no issue that would point at a misread.
     """
+    if not all(values.get(k) for k in TEXT_LAYER_REQUIRED):
+        return False
+    _, issues, _ = sample_quality(CBC(**values))
+    return not issues
+
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _text_layer_cached(pdf_bytes: bytes) -> dict:
+    """CBC values parsed from a PDF's text layer, memoised on its bytes."""
+    return extract_cbc_from_text(pdf_text_layer(pdf_bytes))
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _client_for_key(key_digest: str, _api_key: str):
     import anthropic
+    return anthropic.Anthropic(api_key=_api_key)
 
-    client     = anthropic.Anthropic(api_key=api_key)
-    image_data = base64.standard_b64encode(img_bytes).decode("utf-8")
+
+def _anthropic_client(api_key: str):
+    """One Anthropic client per key, so OCR calls reuse its pooled HTTPS connections."""
+    return _client_for_key(_key_digest(api_key), api_key)
+
+
+def extract_cbc_with_claude(api_key: str, img_bytes: bytes, mime_type: str) -> dict:
+    """
+    Uses Claude (claude-3-5-haiku) vision to extract CBC values from a lab report image.
+    The reply is a forced record_cbc_values tool call, already parsed by the SDK.
+    """
+    client     = _anthropic_client(api_key)
+    image_data = _b64.b64encode(img_bytes).decode("ascii")   # base64 is pure ASCII: no UTF-8 validation
 
     prompt = """Extract all NUMERIC CBC values from this lab report image.
 
@@ -452,11 +794,7 @@ CRITICAL INSTRUCTIONS:
 - Common parameter names: Hemoglobin/Hb/Hgb, RBC/Red Cell Count, WBC/White Cell Count, 
   Platelets/PLT, MCV, MCH, MCHC, Neutrophils/Neut, Lymphocytes/Lymph, etc.
 
-Return ONLY valid JSON (no markdown, no explanation):
-{"rbc":null,"hgb":null,"hct":null,"mcv":null,"mch":null,"mchc":null,"rdw":null,
-"retic":null,"wbc":null,"neut_abs":null,"neut_pct":null,"lymph_abs":null,"lymph_pct":null,
-"mono_abs":null,"mono_pct":null,"eos_abs":null,"eos_pct":null,"baso_abs":null,"baso_pct":null,
-"bands":null,"plt":null,"mpv":null,"immature_gran":null,"nrbc":null}
+Record the values with the record_cbc_values tool (every key, null when absent).
 
 EXAMPLES:
 Report shows "Hemoglobin: 12.5 g/dL" → "hgb":12.5
@@ -468,6 +806,8 @@ Report shows "Platelets: Adequate" → "plt":null
     message = client.messages.create(
         model="claude-3-5-haiku-20241022",
         max_tokens=800,
+        tools=[CBC_TOOL],
+        tool_choice={"type": "tool", "name": CBC_TOOL["name"]},
         messages=[{
             "role": "user",
             "content": [
@@ -484,55 +824,178 @@ Report shows "Platelets: Adequate" → "plt":null
         }],
     )
 
-    text  = message.content[0].text
-    match = re.search(r'\{[^{}]+\}', text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group())
-        except json.JSONDecodeError:
-            pass
+    for block in message.content:
+        if block.type == "tool_use":
+            return dict(block.input)
     return {}
 
 
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _upload_image(file_bytes: bytes, mime: str):
+    """
+    Image to preview and OCR for an upload: PDFs are rasterised, images pass
+    through. Memoised on the raw bytes independently of the API key.
+    Returns (img_bytes, mime) — (None, None) if PDF support is missing.
+    """
+    if mime == "application/pdf":
+        return pdf_to_image_bytes(file_bytes)
+    return file_bytes, mime
+
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _ocr_cached(img_bytes: bytes, mime: str, api_key_hash: str, _api_key: str) -> dict:
+    """
+    OCRs an upload image, memoised on its bytes so reruns and re-uploads of the
+    same report do not trigger another Vision call.
+    api_key_hash isolates entries per user; the key itself is never hashed.
+    """
+    return extract_cbc_with_claude(_api_key, img_bytes, mime)
+
+
 # ─────────────────────────────────────────────────────────
-# SESSION-STATE RAG ENGINE CACHE
+# RAG ENGINE CACHE
 # ─────────────────────────────────────────────────────────
 
+@st.cache_resource(show_spinner=False)
+def _load_kb(kb_path: str) -> list:
+    """
+    Parses the knowledge base JSON once per server lifecycle.
+    The chunk list is shared by the RAG engine and every session's keyword retriever.
+    """
+    from rag_engine import load_knowledge_base
+    return load_knowledge_base(kb_path)
+
+
 @st.cache_resource(show_spinner=False)
 def _build_engine_cached(kb_path: str):
     """
     Builds the vector index once per server lifecycle using local sentence-transformers.
     Cached across all users/reruns — no API key needed for this step.
+    The query embedder is loaded here too (a warm build never touches it), so
+    every per-key view copies the one model and query LRU instead of loading its own.
     """
     from rag_engine import CBCRagEngine
-    engine = CBCRagEngine(kb_path=kb_path)
+    engine = CBCRagEngine(kb_path=kb_path, chunks=_load_kb(kb_path))
     engine.build_index()
+    engine.embedder
     return engine
 
 
-def get_rag_engine(api_key: str = None):
+@st.cache_resource(show_spinner=False)
+def _prewarm_index():
     """
-    Returns the cached RAG engine, injecting the API key for generation.
-    Index is built once locally (no API key needed).
+    Start building the vector index on a background thread once per process, so
+    the first RAG session doesn't block on loading the embedding model. Called
+    only once a RAG mode is selected; disabled with PREWARM_INDEX=0.
+    Returns the thread, or None when disabled.
     """
-    engine         = _build_engine_cached(KB_PATH)
-    engine.api_key = api_key   # update key for generation calls
+    if os.environ.get("PREWARM_INDEX", "1") != "1":
+        return None
+
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+    def _build():
+        try:
+            _build_engine_cached(KB_PATH)
+        except Exception:
+            # show_index_status / the RAG call that needs the index retries and reports it
+            logging.getLogger(__name__).exception("Background index build failed")
+
+    thread = threading.Thread(target=_build, name="prewarm-index", daemon=True)
+    # st.cache_* calls off the script thread need the session's run context
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+    return thread
+
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _engine_for_key(key_digest: str, _api_key: str):
+    engine         = copy.copy(_build_engine_cached(KB_PATH))
+    engine.api_key = _api_key
     return engine
 
 
+def get_rag_engine(api_key: str = None):
+    """
+    Returns a per-API-key view of the cached RAG engine, reused across reruns.
+    The view is a shallow copy — index, embedder and chunks are shared; only
+    api_key differs, so concurrent sessions never overwrite each other's key.
+    Views are cached under a digest of the key, never the key itself.
+    """
+    return _engine_for_key(_key_digest(api_key), api_key)
+
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _query_cache(key_digest: str):
+    """
+    Semantic answer cache for the RAG chat, one per API key (by digest):
+    sessions share answers only with sessions that paid for them.
+    """
+    from rag_engine import SemanticQueryCache
+    return SemanticQueryCache()
+
+
+class _RagCacheMiss(Exception):
+    """Raised by the _rag_cached lookup probe; exceptions are never memoised."""
+
+
+def _cache_miss():
+    raise _RagCacheMiss
+
+
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def _rag_cached(kind: str, entered_key: str, sex: str, age: int, api_key_hash: str, _run):
+    """
+    Memoises one RAG analysis across reruns, keyed on the CBC digest plus the
+    inputs the prompt depends on. _run (unhashed) performs the call; exceptions
+    propagate and are not cached. Work that draws to the page (streaming) can't
+    run in here — probe with _run=_cache_miss, compute outside, then store the
+    finished result with _run=lambda: result.
+    """
+    return _run()
+
+
+@st.cache_resource(show_spinner=False)
 def get_keyword_retriever():
-    if "kw_retriever" not in st.session_state:
-        from rag_engine import create_keyword_retriever
-        st.session_state["kw_retriever"] = create_keyword_retriever(KB_PATH)
-    return st.session_state["kw_retriever"]
+    """Keyword retriever (inverted index is read-only after build), shared by all sessions."""
+    from rag_engine import create_keyword_retriever
+    return create_keyword_retriever(KB_PATH, chunks=_load_kb(KB_PATH))
+
+
+@st.cache_resource(show_spinner="Loading cross-encoder reranker…")
+def _reranker():
+    """Cross-encoder for the opt-in chat rerank stage, loaded once per process."""
+    from rag_engine import CrossEncoderReranker
+    return CrossEncoderReranker()
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _cached_kw_search(query: str, top_k: int) -> list:
+    """Keyword search memoised per (query, top_k) — one scoring pass per abnormality profile."""
+    return get_keyword_retriever().search(query, top_k=top_k)
 
 
 # ─────────────────────────────────────────────────────────
 # INDEX STATUS WIDGET
 # ─────────────────────────────────────────────────────────
 
-def show_index_status():
+def show_index_status(rag_mode: str):
     """Shows the current knowledge index build status in the sidebar."""
+    if rag_mode == "built_in":
+        # Don't load the embedding model just to report on it
+        st.markdown(
+            '<div class="index-building">💤 Not needed for built-in logic — '
+            'loads when a RAG mode is selected</div>',
+            unsafe_allow_html=True
+        )
+        return
+    warmup = _prewarm_index()
+    if warmup is not None and warmup.is_alive():
+        st.markdown(
+            '<div class="index-building">⏳ Building knowledge index…</div>',
+            unsafe_allow_html=True
+        )
+        return
     try:
         engine = _build_engine_cached(KB_PATH)
         if engine.is_ready():
@@ -550,11 +1013,64 @@ def show_index_status():
         st.warning(f"Index status unknown: {e}")
 
 
+# ─────────────────────────────────────────────────────────
+# RAG CHAT  (fragment: Ask reruns only this block)
+# ─────────────────────────────────────────────────────────
+
+@st.fragment
+def rag_chat(api_key: str, data: dict, use_rerank: bool = False):
+    """
+    Question box + answer. As a fragment, typing a question and clicking Ask
+    reruns only this block — the inputs, OCR and any rendered analysis below
+    are left untouched.
+    """
+    step_label("2", "Ask a Clinical Question (RAG Chat)")
+    col_q, col_btn = st.columns([5, 1])
+    with col_q:
+        custom_q = st.text_input(
+            "", label_visibility="collapsed",
+            placeholder="e.g. 'What does elevated RDW with low MCV suggest?' or 'How to differentiate ITP from TTP?'"
+        )
+    with col_btn:
+        ask_clicked = st.button("Ask →", use_container_width=True)
+
+    if not (ask_clicked and custom_q):
+        return
+
+    entered = {k: v for k, v in data.items() if v is not None and v > 0}
+    step_label("●", "Claude RAG Answer")
+    with st.spinner("◆ Retrieving knowledge & generating answer with Claude…"):
+        try:
+            engine  = get_rag_engine(api_key)
+            context = f"CBC context: {cbc_json(entered)}" if entered else ""
+            # Reranked answers draw on different passages: keep them apart in the cache
+            cache_ctx = context + (" | reranked" if use_rerank else "")
+            q_emb   = engine.embedder.embed_query(custom_q)
+            qcache  = _query_cache(_key_digest(api_key))
+            result  = qcache.lookup(q_emb, cache_ctx)
+            if result is None:
+                live   = st.empty()
+                result = engine.generate_with_rag(
+                    query=custom_q, top_k=4, additional_context=context,
+                    on_text=lambda text: live.markdown(
+                        f'<div class="rag-answer">{text}</div>', unsafe_allow_html=True),
+                    reranker=_reranker() if use_rerank else None,
+                )
+                live.empty()
+                qcache.store(custom_q, q_emb, cache_ctx, result)
+            else:
+                st.markdown('<span class="rag-badge">🔁 cached answer</span>', unsafe_allow_html=True)
+            render_rag_answer(result)
+        except Exception as e:
+            st.error(f"RAG error: {e}")
+
+
 # ─────────────────────────────────────────────────────────
 # MAIN APPLICATION
 # ─────────────────────────────────────────────────────────
 
 def main():
+    _warm_kernels()
 
     # ── HEADER ────────────────────────────────────────────
     st.markdown("""
@@ -600,10 +1116,15 @@ def main():
             }[x],
             help="RAG modes require an Anthropic API key for generation"
         )
+        use_rerank = st.toggle(
+            "Rerank chat passages (cross-encoder)", value=False,
+            help="Retrieves 8× candidates and reorders them with a local cross-encoder "
+                 "(downloads ~2 GB on first use). Applies to the RAG chat only."
+        )
 
         st.divider()
         st.markdown("### 📚 Knowledge Index")
-        show_index_status()
+        show_index_status(rag_mode)
         st.markdown("""
         <div style="font-size:.72rem;color:#8b949e;line-height:1.7;margin-top:6px">
         Index builds automatically using local sentence-transformers.<br>
@@ -627,39 +1148,28 @@ def main():
     data = {}
 
     with in_tab:
-        c1, c2, c3 = st.columns(3)
-        with c1:
-            st.markdown('<div style="color:#f85149;font-weight:600;margin-bottom:8px">🔴 Red Blood Cell Series</div>', unsafe_allow_html=True)
-            data["rbc"]   = nz(st.number_input("RBC (×10¹²/L)",        0.0, 15.0,  0.0, 0.01,  "%.2f"))
-            data["hgb"]   = nz(st.number_input("Hemoglobin (g/dL)",     0.0, 25.0,  0.0, 0.1,   "%.1f"))
-            data["hct"]   = nz(st.number_input("Hematocrit (%)",        0.0, 75.0,  0.0, 0.1,   "%.1f"))
-            data["mcv"]   = nz(st.number_input("MCV (fL)",              0.0, 200.0, 0.0, 0.1,   "%.1f"))
-            data["mch"]   = nz(st.number_input("MCH (pg)",              0.0, 60.0,  0.0, 0.1,   "%.1f"))
-            data["mchc"]  = nz(st.number_input("MCHC (g/dL)",          0.0, 50.0,  0.0, 0.1,   "%.1f"))
-            data["rdw"]   = nz(st.number_input("RDW (%)",               0.0, 30.0,  0.0, 0.1,   "%.1f"))
-            data["retic"] = nz(st.number_input("Reticulocytes (%)",     0.0, 20.0,  0.0, 0.01,  "%.2f"))
-        with c2:
-            st.markdown('<div style="color:#58a6ff;font-weight:600;margin-bottom:8px">⚪ White Blood Cell Series</div>', unsafe_allow_html=True)
-            data["wbc"]       = nz(st.number_input("WBC (×10⁹/L)",              0.0, 500.0, 0.0, 0.1,   "%.1f"))
-            data["neut_abs"]  = nz(st.number_input("Neutrophils Abs (×10⁹/L)",  0.0, 300.0, 0.0, 0.01,  "%.2f"))
-            data["neut_pct"]  = nz(st.number_input("Neutrophils (%)",            0.0, 100.0, 0.0, 0.1,   "%.1f"))
-            data["lymph_abs"] = nz(st.number_input("Lymphocytes Abs (×10⁹/L)", 0.0, 200.0, 0.0, 0.01,  "%.2f"))
-            data["lymph_pct"] = nz(st.number_input("Lymphocytes (%)",           0.0, 100.0, 0.0, 0.1,   "%.1f"))
-            data["mono_abs"]  = nz(st.number_input("Monocytes Abs (×10⁹/L)",   0.0, 50.0,  0.0, 0.01,  "%.2f"))
-            data["eos_abs"]   = nz(st.number_input("Eosinophils Abs (×10⁹/L)", 0.0, 50.0,  0.0, 0.001, "%.3f"))
-            data["baso_abs"]  = nz(st.number_input("Basophils Abs (×10⁹/L)",   0.0, 10.0,  0.0, 0.001, "%.3f"))
-            data["bands"]     = nz(st.number_input("Bands (%)",                 0.0, 100.0, 0.0, 0.1,   "%.1f"))
-        with c3:
-            st.markdown('<div style="color:#d29922;font-weight:600;margin-bottom:8px">🟡 Platelet Series</div>', unsafe_allow_html=True)
-            data["plt"] = nz(st.number_input("Platelets (×10⁹/L)", 0.0, 3000.0, 0.0, 1.0, "%.0f"))
-            data["mpv"] = nz(st.number_input("MPV (fL)",            0.0, 30.0,   0.0, 0.1, "%.1f"))
-            st.divider()
-            st.markdown('<div style="color:#bc8cff;font-weight:600;margin-bottom:8px">🔬 Extended Parameters</div>', unsafe_allow_html=True)
-            data["immature_gran"] = nz(st.number_input("Immature Granulocytes (%)", 0.0, 100.0, 0.0, 0.1, "%.1f"))
-            data["nrbc"]          = nz(st.number_input("Nucleated RBCs (%)",        0.0, 100.0, 0.0, 0.1, "%.1f"))
-            data["mono_pct"]      = nz(st.number_input("Monocytes (%)",             0.0, 100.0, 0.0, 0.1, "%.1f"))
-            data["eos_pct"]       = nz(st.number_input("Eosinophils (%)",           0.0, 100.0, 0.0, 0.1, "%.1f"))
-            data["baso_pct"]      = nz(st.number_input("Basophils (%)",             0.0, 100.0, 0.0, 0.1, "%.1f"))
+        grid = st.data_editor(
+            _param_grid(),
+            column_config={
+                "Value": st.column_config.NumberColumn("Value", min_value=0.0, step=0.001),
+            },
+            disabled=["Series", "Parameter", "Unit"],
+            num_rows="fixed",
+            hide_index=True,
+            use_container_width=True,
+            key="cbc_grid",
+        )
+        # Whole grid in one pass: empty (NaN) and zero cells → None, over-max rejected
+        vals     = grid["Value"].to_numpy(dtype=float)
+        too_high = vals > _PARAM_MAX
+        keep     = (vals > 0) & ~too_high
+        data.update((spec[0], v if ok else None)
+                    for spec, v, ok in zip(PARAM_SPEC, vals.tolist(), keep.tolist()))
+        if too_high.any():
+            st.warning("Ignored out-of-range values: " + ", ".join(
+                f"{name} (max {max_v:g} {unit})"
+                for (_, _, name, unit, max_v), hit in zip(PARAM_SPEC, too_high.tolist()) if hit
+            ))
 
     with upload_tab:
         if not api_key:
@@ -676,62 +1186,55 @@ def main():
             uploaded = st.file_uploader("", type=["pdf", "jpg", "jpeg", "png"],
                                         label_visibility="collapsed")
             if uploaded:
-                with st.spinner("🔍 Claude Vision extracting values…"):
+                # Preview first, so the page isn't blank while Vision runs
+                with st.spinner("📄 Preparing report…"):
+                    img_bytes, mime = _upload_image(uploaded.getvalue(), uploaded.type)
+                if img_bytes is None:
+                    st.error("PDF parsing requires pypdfium2 or PyMuPDF. Install: pip install pypdfium2")
+                else:
+                    st.image(img_bytes, caption="Uploaded Report", use_container_width=True)
                     try:
-                        file_bytes = uploaded.read()
+                        # Digital PDFs usually carry a text layer: parse it and skip Vision
+                        extracted = {}
+                        source    = "PDF text layer"
                         if uploaded.type == "application/pdf":
-                            img_bytes, mime = pdf_to_image_bytes(file_bytes)
-                            if img_bytes is None:
-                                st.error("PDF parsing requires PyMuPDF. Install: pip install PyMuPDF")
-                                img_bytes = None
-                        else:
-                            img_bytes, mime = file_bytes, uploaded.type
-
-                        if img_bytes:
-                            st.image(img_bytes, caption="Uploaded Report",
-                                     use_container_width=True)
-                            extracted = extract_cbc_with_claude(api_key, img_bytes, mime)
-                            if extracted:
-                                n = sum(1 for v in extracted.values() if v is not None)
-                                if n == 0:
-                                    st.warning(
-                                        "⚠️ No numeric CBC values found. This may be:\n"
-                                        "• A peripheral smear interpretation page (qualitative only)\n"
-                                        "• A page without the main CBC results table\n"
-                                        "• An unsupported report format\n\n"
-                                        "**Try uploading the page with numeric values** "
-                                        "(Hemoglobin, WBC count, Platelet count, etc.)"
-                                    )
-                                else:
-                                    for k, v in extracted.items():
-                                        if v is not None and k in data:
-                                            data[k] = float(v)
-                                    st.success(f"✅ Claude extracted {n} parameters")
-                                    st.json({k: v for k, v in extracted.items() if v is not None})
+                            with st.spinner("📄 Reading report text…"):
+                                extracted = _text_layer_cached(uploaded.getvalue())
+                        if not text_layer_usable(extracted):
+                            with st.spinner("🔍 Claude Vision extracting values…"):
+                                extracted = _ocr_cached(img_bytes, mime, _key_digest(api_key), api_key)
+                            source = "Claude Vision"
+                        if extracted:
+                            n = sum(1 for v in extracted.values() if v is not None)
+                            if n == 0:
+                                st.warning(
+                                    "⚠️ No numeric CBC values found. This may be:\n"
+                                    "• A peripheral smear interpretation page (qualitative only)\n"
+                                    "• A page without the main CBC results table\n"
+                                    "• An unsupported report format\n\n"
+                                    "**Try uploading the page with numeric values** "
+                                    "(Hemoglobin, WBC count, Platelet count, etc.)"
+                                )
+                            else:
+                                for k, v in extracted.items():
+                                    if v is not None and k in data:
+                                        data[k] = float(v)
+                                st.success(f"✅ Extracted {n} parameters ({source})")
+                                st.json({k: v for k, v in extracted.items() if v is not None})
                     except Exception as e:
                         st.error(f"Extraction error: {e}")
 
     # ── RAG CHAT ─────────────────────────────────────────
-    custom_q    = None
-    ask_clicked = False
     if rag_mode != "built_in" and api_key:
         st.divider()
-        step_label("2", "Ask a Clinical Question (RAG Chat)")
-        col_q, col_btn = st.columns([5, 1])
-        with col_q:
-            custom_q = st.text_input(
-                "", label_visibility="collapsed",
-                placeholder="e.g. 'What does elevated RDW with low MCV suggest?' or 'How to differentiate ITP from TTP?'"
-            )
-        with col_btn:
-            ask_clicked = st.button("Ask →", use_container_width=True)
+        rag_chat(api_key, data, use_rerank)
 
     # ── ANALYZE BUTTON ────────────────────────────────────
     st.divider()
     analyze_clicked = st.button("🔬 Run Complete CBC Analysis",
                                 type="primary", use_container_width=True)
 
-    if not analyze_clicked and not ask_clicked:
+    if not analyze_clicked:
         st.markdown("""
         <div class="alert alert-b" style="text-align:center;padding:20px">
           Fill in CBC values above, then click <strong>Run Complete CBC Analysis</strong><br>
@@ -747,69 +1250,30 @@ def main():
         )
         return
 
+    cbc     = CBC(**data)
     entered = {k: v for k, v in data.items() if v is not None and v > 0}
-    if not entered and analyze_clicked:
+    if not entered:
         st.error("⚠️ Please enter at least some CBC values.")
         return
-
-    # ── RAG CHAT RESPONSE ─────────────────────────────────
-    if ask_clicked and custom_q and api_key:
-        step_label("●", "Claude RAG Answer")
-        with st.spinner("◆ Retrieving knowledge & generating answer with Claude…"):
-            try:
-                engine = get_rag_engine(api_key)
-                result = engine.generate_with_rag(
-                    query=custom_q, top_k=4,
-                    additional_context=(f"CBC context: {json.dumps(entered)}" if entered else "")
-                )
-                render_rag_answer(result)
-            except Exception as e:
-                st.error(f"RAG error: {e}")
-        return
+    entered_json = cbc_json(entered)
+    entered_key  = hashlib.blake2b(entered_json.encode(), digest_size=16).hexdigest()
+    key_hash     = _key_digest(api_key)
 
     # ═══════════════════════════════════════════════════════
     # FULL ANALYSIS OUTPUT
     # ═══════════════════════════════════════════════════════
-    hgb_lo, hgb_hi = (13.5, 17.5) if sex == "M" else (12.0, 15.5)
-    rbc_lo, rbc_hi = (4.5, 5.9)   if sex == "M" else (4.0, 5.2)
-    hct_lo, hct_hi = (41.0, 53.0) if sex == "M" else (36.0, 46.0)
-    hgb_crit       = CRITICAL_RANGES["hgb_m"]
+    T = THRESH[sex]
 
     # ── 1. PARAMETER REVIEW ───────────────────────────────
     step_label("1", "CBC Parameter Review")
-    pc1, pc2, pc3 = st.columns(3)
-    with pc1:
-        st.markdown('<div style="color:#f85149;font-size:.8rem;font-weight:700;margin-bottom:8px;letter-spacing:1px">RBC SERIES</div>', unsafe_allow_html=True)
-        render_param_card("RBC",           data.get("rbc"),       "×10¹²/L", rbc_lo, rbc_hi)
-        render_param_card("Hemoglobin",    data.get("hgb"),       "g/dL",    hgb_lo, hgb_hi, hgb_crit[0], hgb_crit[1])
-        render_param_card("Hematocrit",    data.get("hct"),       "%",       hct_lo, hct_hi)
-        render_param_card("MCV",           data.get("mcv"),       "fL",      *REFERENCE_RANGES["mcv"][:2])
-        render_param_card("MCH",           data.get("mch"),       "pg",      *REFERENCE_RANGES["mch"][:2])
-        render_param_card("MCHC",          data.get("mchc"),      "g/dL",    *REFERENCE_RANGES["mchc"][:2])
-        render_param_card("RDW",           data.get("rdw"),       "%",       *REFERENCE_RANGES["rdw"][:2])
-        render_param_card("Reticulocytes", data.get("retic"),     "%",       *REFERENCE_RANGES["retic"][:2])
-    with pc2:
-        st.markdown('<div style="color:#58a6ff;font-size:.8rem;font-weight:700;margin-bottom:8px;letter-spacing:1px">WBC SERIES</div>', unsafe_allow_html=True)
-        render_param_card("WBC",             data.get("wbc"),       "×10⁹/L", *REFERENCE_RANGES["wbc"][:2],      *CRITICAL_RANGES["wbc"])
-        render_param_card("Neutrophils Abs", data.get("neut_abs"),  "×10⁹/L", *REFERENCE_RANGES["neut_abs"][:2], CRITICAL_RANGES["neut_abs"][0], None)
-        render_param_card("Neutrophils %",   data.get("neut_pct"),  "%",       *REFERENCE_RANGES["neut_pct"][:2])
-        render_param_card("Lymphocytes Abs", data.get("lymph_abs"), "×10⁹/L", *REFERENCE_RANGES["lymph_abs"][:2])
-        render_param_card("Lymphocytes %",   data.get("lymph_pct"), "%",       *REFERENCE_RANGES["lymph_pct"][:2])
-        render_param_card("Monocytes Abs",   data.get("mono_abs"),  "×10⁹/L", *REFERENCE_RANGES["mono_abs"][:2])
-        render_param_card("Eosinophils Abs", data.get("eos_abs"),   "×10⁹/L", *REFERENCE_RANGES["eos_abs"][:2])
-        render_param_card("Basophils Abs",   data.get("baso_abs"),  "×10⁹/L", *REFERENCE_RANGES["baso_abs"][:2])
-    with pc3:
-        st.markdown('<div style="color:#d29922;font-size:.8rem;font-weight:700;margin-bottom:8px;letter-spacing:1px">PLATELET SERIES</div>', unsafe_allow_html=True)
-        render_param_card("Platelets", data.get("plt"), "×10⁹/L", *REFERENCE_RANGES["plt"][:2], *CRITICAL_RANGES["plt"])
-        render_param_card("MPV",       data.get("mpv"), "fL",     *REFERENCE_RANGES["mpv"][:2])
-        if data.get("immature_gran"):
-            render_param_card("Immature Granulocytes", data["immature_gran"], "%", 0, 0)
-        if data.get("nrbc"):
-            render_param_card("Nucleated RBCs", data["nrbc"], "%", 0, 0)
+    for col, (title, colour, _), arrays in zip(st.columns(3), PARAM_REVIEW, _REVIEW_ARR[sex]):
+        with col:
+            st.markdown(f'<div style="color:{colour};font-size:.8rem;font-weight:700;margin-bottom:8px;letter-spacing:1px">{title}</div>', unsafe_allow_html=True)
+            render_param_column(cbc, arrays)
 
     # ── 2. SAMPLE QUALITY ─────────────────────────────────
     step_label("2", "Sample Quality Assessment")
-    q_score, q_issues, q_warns = sample_quality(data)
+    q_score, q_issues, q_warns = sample_quality(cbc)
     fill = "#3fb950" if q_score >= 80 else ("#d29922" if q_score >= 50 else "#f85149")
     qlbl = "✅ Good Quality" if q_score >= 80 else ("⚠ Questionable" if q_score >= 50 else "🔴 Poor Quality")
     st.markdown(f"""
@@ -831,48 +1295,88 @@ def main():
     tabs = st.tabs(["🩸 Anemia", "⚪ Neutrophil", "🟡 Platelets",
                     "🛡 Immunodeficiency", "🔴 Polycythemia", "🔬 Other Findings"])
 
-    def rag_or_builtin(rag_fn, builtin_fn, *args):
+    wbc_v   = cbc.wbc or 0
+    lymph_v = cbc.lymph_abs or (wbc_v * (cbc.lymph_pct or 0) / 100)
+    neut_v  = cbc.neut_abs
+    plt_v   = cbc.plt
+    mpv_v   = cbc.mpv
+    pid_flags = []
+    if lymph_v and lymph_v < 1.0: pid_flags.append(f"Lymphopenia (ALC {lymph_v:.2f})")
+    if neut_v  and neut_v  < 0.5: pid_flags.append(f"Severe neutropenia (ANC {neut_v:.2f})")
+    if plt_v and plt_v < 100 and mpv_v and mpv_v < 7.5 and sex == "M":
+        pid_flags.append("Low PLT + low MPV in male (Wiskott-Aldrich pattern)")
+    hgb_hi2        = T["hgb_hi"]
+    hgb_v          = cbc.hgb
+    erythrocytosis = bool(hgb_v and hgb_v > hgb_hi2)
+
+    # Every RAG section (each tab, plus the narrative in rag_full) is an
+    # independent network call: fire them all together, render from results.
+    sections = ("anemia", "neutrophil", "platelets") \
+        + (("immunodeficiency",) if pid_flags else ()) \
+        + (("polycythemia",) if erythrocytosis else ()) \
+        + (("full",) if rag_mode == "rag_full" else ())
+    rag_results = {}
+    if rag_mode != "built_in" and api_key:
+        cache_key = ("sections:" + ",".join(sections), entered_key, sex, age, key_hash)
+        with st.status("◆ Loading analyses…") as status:
+            reused = True
+            try:
+                rag_results = _rag_cached(*cache_key, _cache_miss)
+            except _RagCacheMiss:
+                reused = False
+                status.update(label=f"◆ Claude is retrieving & analysing {len(sections)} sections in parallel…")
+                # Stream each tab's answer into its tab while all sections run
+                live = {s: tabs[i].empty() for s, i in SECTION_TABS.items() if s in sections}
+                try:
+                    rag_results = get_rag_engine(api_key).analyze_many(
+                        data, sex, age, sections,
+                        on_text=lambda section, text: section in live and live[section].markdown(
+                            f'<div class="rag-answer">{text}</div>', unsafe_allow_html=True),
+                    )
+                except Exception as e:
+                    rag_results = {s: e for s in sections}
+                for ph in live.values():
+                    ph.empty()
+                if not any(isinstance(r, Exception) for r in rag_results.values()):
+                    _rag_cached(*cache_key, lambda: rag_results)
+            failed = [s for s in sections if isinstance(rag_results.get(s), Exception)]
+            for s in sections:
+                st.write(f"{'✗' if s in failed else '✓'} {s}")
+            status.update(
+                label=(f"◆ {len(failed)} of {len(sections)} analyses failed" if failed else
+                       f"◆ {len(sections)} analyses reused from this CBC's earlier run" if reused else
+                       f"◆ {len(sections)} analyses ready"),
+                state="error" if failed else "complete", expanded=False,
+            )
+
+    def rag_or_builtin(section, builtin_fn, *args):
         if rag_mode == "built_in" or not api_key:
             items = builtin_fn(*args)
             if not items: render_alert("✅ Within normal range.", "g")
             for k, v in items: render_alert(v, k)
             return
-        with st.spinner("◆ Claude is retrieving & analysing…"):
-            try:
-                engine = get_rag_engine(api_key)
-                result = rag_fn(engine)
-                if result: render_rag_answer(result)
-                else:      render_alert("✅ Within normal range.", "g")
-            except Exception as e:
-                st.error(f"Claude RAG error: {e}")
-                items = builtin_fn(*args)
-                for k, v in items: render_alert(v, k)
+        result = rag_results.get(section)
+        if isinstance(result, Exception):
+            st.error(f"Claude RAG error: {result}")
+            items = builtin_fn(*args)
+            for k, v in items: render_alert(v, k)
+        elif result: render_rag_answer(result)
+        else:        render_alert("✅ Within normal range.", "g")
 
     with tabs[0]:
         st.markdown("#### Anemia Evaluation")
-        rag_or_builtin(lambda eng: eng.analyze_anemia(data, sex), built_in_anemia, data, sex)
+        rag_or_builtin("anemia", built_in_anemia, cbc, sex)
 
     with tabs[1]:
         st.markdown("#### Neutrophil Evaluation")
-        rag_or_builtin(lambda eng: eng.analyze_neutrophil_abnormality(data), built_in_neutrophil, data)
+        rag_or_builtin("neutrophil", built_in_neutrophil, cbc)
 
     with tabs[2]:
         st.markdown("#### Platelet Evaluation")
-        rag_or_builtin(lambda eng: eng.analyze_platelet_abnormality(data), built_in_platelets, data)
+        rag_or_builtin("platelets", built_in_platelets, cbc)
 
     with tabs[3]:
         st.markdown("#### Primary Immunodeficiency Screening")
-        wbc_v   = data.get("wbc", 0) or 0
-        lymph_v = data.get("lymph_abs") or (wbc_v * (data.get("lymph_pct") or 0) / 100)
-        neut_v  = data.get("neut_abs")
-        plt_v   = data.get("plt")
-        mpv_v   = data.get("mpv")
-        pid_flags = []
-        if lymph_v and lymph_v < 1.0: pid_flags.append(f"Lymphopenia (ALC {lymph_v:.2f})")
-        if neut_v  and neut_v  < 0.5: pid_flags.append(f"Severe neutropenia (ANC {neut_v:.2f})")
-        if plt_v and plt_v < 100 and mpv_v and mpv_v < 7.5 and sex == "M":
-            pid_flags.append("Low PLT + low MPV in male (Wiskott-Aldrich pattern)")
-
         if rag_mode == "built_in" or not api_key:
             if pid_flags:
                 for f in pid_flags: render_alert(f"🛡 PID Flag: {f}", "p")
@@ -880,21 +1384,18 @@ def main():
             else:
                 render_alert("✅ No CBC-based PID flags. Note: antibody deficiencies (CVID, XLA) can present with a normal CBC.", "g")
         elif pid_flags:
-            with st.spinner("◆ Claude RAG: immunodeficiency guidelines…"):
-                try:
-                    engine = get_rag_engine(api_key)
-                    render_rag_answer(engine.analyze_immunodeficiency_risk(data, sex, age))
-                except Exception as e:
-                    st.error(f"Claude RAG error: {e}")
-                    for f in pid_flags: render_alert(f"🛡 PID Flag: {f}", "p")
+            result = rag_results.get("immunodeficiency")
+            if isinstance(result, Exception):
+                st.error(f"Claude RAG error: {result}")
+                for f in pid_flags: render_alert(f"🛡 PID Flag: {f}", "p")
+            else:
+                render_rag_answer(result)
         else:
             render_alert("✅ No CBC-based PID flags identified.", "g")
 
     with tabs[4]:
         st.markdown("#### Erythrocytosis / Polycythemia")
-        hgb_hi2 = 17.5 if sex == "M" else 15.5
-        hgb_v   = data.get("hgb")
-        if hgb_v and hgb_v > hgb_hi2:
+        if erythrocytosis:
             render_alert(f"🔴 **Erythrocytosis** — Hgb {hgb_v:.1f} g/dL (>{hgb_hi2} g/dL)", "r")
             render_alert(
                 "→ Distinguish relative (dehydration) from absolute erythrocytosis.\n"
@@ -903,75 +1404,55 @@ def main():
                 "→ Primary PV: JAK2+ + panmyelosis; bone marrow biopsy for confirmation.", "b"
             )
             if rag_mode != "built_in" and api_key:
-                with st.spinner("◆ Claude RAG: polycythaemia guidelines…"):
-                    try:
-                        engine = get_rag_engine(api_key)
-                        result = engine.generate_with_rag(
-                            f"Patient has erythrocytosis: Hgb {hgb_v} g/dL ({sex}). Classify and provide workup.",
-                            top_k=3,
-                            additional_context=f"Sex:{sex}, CBC:{json.dumps(entered)}"
-                        )
-                        render_rag_answer(result)
-                    except Exception as e:
-                        st.error(f"Claude RAG error: {e}")
+                result = rag_results.get("polycythemia")
+                if isinstance(result, Exception):
+                    st.error(f"Claude RAG error: {result}")
+                else:
+                    render_rag_answer(result)
         else:
             render_alert("✅ No erythrocytosis detected.", "g")
 
     with tabs[5]:
         st.markdown("#### Other Findings")
         found   = False
-        eos_v   = data.get("eos_abs")
-        wbc_ref = data.get("wbc", 0) or 0
+        eos_v   = cbc.eos_abs
+        wbc_ref = cbc.wbc or 0
         if eos_v and eos_v > 0.5:
             found = True
             render_alert(f"🟠 **Eosinophilia** — AEC {eos_v:.2f} ×10⁹/L "
                          f"{'(Hypereosinophilia — screen for organ damage)' if eos_v>=1.5 else ''}", "a")
             render_alert("→ Consider: parasites (stool O&P ×3), drug reaction, atopy, IBD, malignancy. Check IgE. ECG if severe.", "b")
-        lymph_hi = data.get("lymph_abs") or (wbc_ref * (data.get("lymph_pct") or 0) / 100)
+        lymph_hi = cbc.lymph_abs or (wbc_ref * (cbc.lymph_pct or 0) / 100)
         if lymph_hi and lymph_hi > 4.8:
             found = True
             render_alert(f"🔵 **Lymphocytosis** — ALC {lymph_hi:.2f} ×10⁹/L "
                          f"{'(Suspect CLL if persistent >5)' if lymph_hi>5 else ''}", "a")
             render_alert("→ Reactive (EBV/CMV/viral) vs clonal (CLL: CD5+/CD19+/CD23+). Flow cytometry if >5 ×10⁹/L.", "b")
-        if data.get("immature_gran") and data["immature_gran"] > 0:
+        if cbc.immature_gran and cbc.immature_gran > 0:
             found = True
-            render_alert(f"⚪ **Immature Granulocytes** {data['immature_gran']:.1f}% — smear; left shift, CML, MDS, sepsis.", "a")
-        if data.get("nrbc") and data["nrbc"] > 0:
+            render_alert(f"⚪ **Immature Granulocytes** {cbc.immature_gran:.1f}% — smear; left shift, CML, MDS, sepsis.", "a")
+        if cbc.nrbc and cbc.nrbc > 0:
             found = True
-            render_alert(f"🔴 **Nucleated RBCs** {data['nrbc']:.1f}% — marrow infiltration, asplenia, haemolysis, hypoxia, myelofibrosis.", "a")
+            render_alert(f"🔴 **Nucleated RBCs** {cbc.nrbc:.1f}% — marrow infiltration, asplenia, haemolysis, hypoxia, myelofibrosis.", "a")
         if not found:
             render_alert("✅ No other notable findings.", "g")
 
     # ── 4. COMPREHENSIVE CLAUDE RAG NARRATIVE ─────────────
     if rag_mode == "rag_full" and api_key:
         step_label("4", "Comprehensive Claude RAG Clinical Narrative")
-        with st.spinner("◆ Claude is synthesising a full clinical narrative…"):
-            try:
-                engine = get_rag_engine(api_key)
-                result = engine.full_rag_analysis(data, sex, age)
-                render_rag_answer(result)
-            except Exception as e:
-                st.error(f"Comprehensive RAG error: {e}")
-                import traceback; st.code(traceback.format_exc())
+        result = rag_results.get("full")
+        if isinstance(result, Exception):
+            st.error(f"Comprehensive RAG error: {result}")
+            st.code("".join(traceback.format_exception(result)))
+        else:
+            render_rag_answer(result)
 
     # ── 5. KEYWORD RAG (built-in, no API) ─────────────────
     if rag_mode == "built_in" and entered:
         step_label("4", "Knowledge Base Quick Search (Keyword Fallback)")
-        kw_parts = []
-        if data.get("hgb") and data["hgb"] < (13.5 if sex=="M" else 12.0):
-            kw_parts.append("anemia hemoglobin low")
-        if data.get("mcv") and data["mcv"] < 80:
-            kw_parts.append("microcytic MCV low iron deficiency thalassemia")
-        if data.get("mcv") and data["mcv"] > 100:
-            kw_parts.append("macrocytic B12 folate MDS")
-        if data.get("neut_abs") and data["neut_abs"] > 7.7: kw_parts.append("neutrophilia infection CML")
-        if data.get("neut_abs") and data["neut_abs"] < 1.8: kw_parts.append("neutropenia drug autoimmune congenital")
-        if data.get("plt") and data["plt"] < 150: kw_parts.append("thrombocytopenia ITP platelet")
-        if data.get("lymph_abs") and data["lymph_abs"] < 1.0: kw_parts.append("lymphopenia immunodeficiency SCID")
-
+        kw_parts = keyword_terms(cbc, sex)
         if kw_parts:
-            retriever = get_keyword_retriever()
-            chunks    = retriever.search(" ".join(kw_parts), top_k=3)
+            chunks = _cached_kw_search(" ".join(kw_parts), 3)
             st.markdown('<div style="font-size:.8rem;color:#8b949e;margin-bottom:8px">'
                         'Top 3 relevant knowledge passages (keyword search):</div>', unsafe_allow_html=True)
             for i, chunk in enumerate(chunks, 1):
@@ -982,33 +1463,18 @@ def main():
 
     # ── SUMMARY TABLE ─────────────────────────────────────
     step_label("5", "Abnormal Findings Summary")
-    checks = [
-        ("Hemoglobin",      data.get("hgb"),      hgb_lo, hgb_hi, "g/dL"),
-        ("WBC",             data.get("wbc"),       4.5,    11.0,   "×10⁹/L"),
-        ("Platelets",       data.get("plt"),       150,    400,    "×10⁹/L"),
-        ("MCV",             data.get("mcv"),       80,     100,    "fL"),
-        ("MCHC",            data.get("mchc"),      32,     36,     "g/dL"),
-        ("RDW",             data.get("rdw"),       11.5,   14.5,   "%"),
-        ("Neutrophils Abs", data.get("neut_abs"),  1.8,    7.7,    "×10⁹/L"),
-        ("Lymphocytes Abs", data.get("lymph_abs"), 1.0,    4.8,    "×10⁹/L"),
-        ("Eosinophils Abs", data.get("eos_abs"),   0.0,    0.5,    "×10⁹/L"),
-        ("MPV",             data.get("mpv"),       7.5,    12.5,   "fL"),
-        ("Reticulocytes",   data.get("retic"),     0.5,    2.5,    "%"),
-    ]
-    rows = []
-    for name, val, lo, hi, unit in checks:
-        if val is None: continue
-        status = classify_value(val, lo, hi)
-        if status != "ok":
-            rows.append({
-                "Parameter": name,
-                "Value":     f"{val:.2f} {unit}",
-                "Reference": f"{lo}–{hi} {unit}",
-                "Status":    "⬇ Low" if "low" in status else "⬆ High",
-            })
-    if rows:
-        import pandas as pd
-        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+    lo   = _SUMMARY_LO_ARR[sex]
+    hi   = _SUMMARY_HI_ARR[sex]
+    vals = np.array([getattr(cbc, k) for k in SUMMARY_KEYS], dtype=float)  # None → NaN
+    idx  = np.flatnonzero((vals < lo) | (vals > hi)).tolist()
+    if idx:
+        summary = pd.DataFrame({
+            "Parameter": [SUMMARY_NAMES[i] for i in idx],
+            "Value":     [f"{vals[i]:.2f} {SUMMARY_UNITS[i]}" for i in idx],
+            "Reference": [f"{SUMMARY_LO[sex][i]}–{SUMMARY_HI[sex][i]} {SUMMARY_UNITS[i]}" for i in idx],
+            "Status":    ["⬇ Low" if vals[i] < lo[i] else "⬆ High" for i in idx],
+        }, dtype=str)
+        st.dataframe(summary, use_container_width=True, hide_index=True)
     else:
         render_alert("✅ All entered parameters within reference ranges.", "g")
 
@@ -4,19 +4,25 @@ CBC RAG Engine — Retrieval-Augmented Generation for Clinical CBC Analysis
 Architecture (Claude edition):
   Embeddings : sentence-transformers/all-MiniLM-L6-v2  (local, no API key)
   Generation : Anthropic Claude API  (claude-3-5-haiku-20241022)
-  Retrieval  : Cosine similarity (pure Python)
+  Retrieval  : Cosine similarity (FAISS inner-product index; pure-Python fallback)
 """
 
+import functools
+import hashlib
+import heapq
+import importlib.util
 import json
 import math
 import re
 import os
+import threading
 import time
-from typing import Optional
+from collections import OrderedDict
+from typing import Callable, Optional
 
 
 # ─────────────────────────────────────────────────────────
-# VECTOR MATH  (pure Python — no numpy required)
+# VECTOR MATH  (pure Python fallback — used when faiss is not installed)
 # ─────────────────────────────────────────────────────────
 
 def cosine_similarity(a: list, b: list) -> float:
@@ -33,16 +39,46 @@ def cosine_similarity(a: list, b: list) -> float:
 # ─────────────────────────────────────────────────────────
 
 def load_knowledge_base(kb_path: str) -> list:
-    """Load chunks from JSON knowledge base file."""
-    with open(kb_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    """Load chunks from JSON knowledge base file (parsed with orjson when installed)."""
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+    if orjson is not None:
+        with open(kb_path, "rb") as f:
+            data = orjson.loads(f.read())
+    else:
+        with open(kb_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
     return data["chunks"]
 
 
+def cbc_json(cbc_values: dict) -> str:
+    """Compact, key-sorted JSON of the entered CBC values (orjson when installed)."""
+    entered = {k: v for k, v in cbc_values.items() if v}
+    try:
+        import orjson
+    except ImportError:
+        return json.dumps(entered, sort_keys=True, separators=(",", ":"))
+    return orjson.dumps(entered, option=orjson.OPT_SORT_KEYS).decode()
+
+
 # ─────────────────────────────────────────────────────────
 # LOCAL SENTENCE-TRANSFORMER EMBEDDER  (no API key needed)
 # ─────────────────────────────────────────────────────────
 
+def _onnx_backend_supported() -> bool:
+    """True when optimum + onnxruntime are installed and sentence-transformers accepts backend="onnx" (3.2+)."""
+    if not (importlib.util.find_spec("optimum") and importlib.util.find_spec("onnxruntime")):
+        return False
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+        major, minor = (int(part) for part in version("sentence-transformers").split(".")[:2])
+    except (PackageNotFoundError, ValueError):
+        return False
+    return (major, minor) >= (3, 2)
+
+
 class SentenceTransformerEmbedder:
     """
     Local semantic embedder using sentence-transformers.
@@ -50,44 +86,253 @@ class SentenceTransformerEmbedder:
     No API key required — runs entirely on device.
     """
 
-    MODEL_NAME = "all-MiniLM-L6-v2"
+    MODEL_NAME       = "all-MiniLM-L6-v2"
+    QUERY_CACHE_SIZE = 256   # LRU of query embeddings, keyed by normalised text
+    # With optimum[onnxruntime] and sentence-transformers>=3.2 installed the model
+    # runs as the int8 ONNX export shipped in its hub repo (~4x smaller weights,
+    # 2-3x faster CPU encoding). EMBED_BACKEND=torch forces the full-precision model.
+    ONNX_FILE        = "onnx/model_quint8_avx2.onnx"
+    BACKEND          = ("onnx" if os.environ.get("EMBED_BACKEND") != "torch" and _onnx_backend_supported()
+                        else "torch")
 
     def __init__(self, model_name: str = MODEL_NAME):
         from sentence_transformers import SentenceTransformer
-        self._model = SentenceTransformer(model_name)
+        if self.BACKEND == "onnx":
+            self._model = SentenceTransformer(model_name, backend="onnx",
+                                              model_kwargs={"file_name": self.ONNX_FILE})
+        else:
+            self._model = SentenceTransformer(model_name)
+        self._query_cache = OrderedDict()   # normalised query text -> embedding
+        self._lock        = threading.Lock()
+        # Uncased tokenizers (MiniLM) embed "Anemia" and "anemia" identically
+        self._lowercase   = bool(getattr(self._model.tokenizer, "do_lower_case", False))
 
     def embed(self, text: str, **kwargs) -> list:
         """Embed a single text string; returns list of floats."""
         return self._model.encode(text, convert_to_numpy=True).tolist()
 
     def embed_query(self, text: str) -> list:
-        """Embed a search query (same as embed for MiniLM)."""
-        return self.embed(text)
+        """Embed a search query (same as embed for MiniLM), memoised per normalised text."""
+        return self.embed_queries([text])[0]
 
-    def embed_batch(self, texts: list, **kwargs) -> list:
-        """Embed a list of texts; returns list of float lists."""
-        vecs = self._model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+    def embed_queries(self, texts: list) -> list:
+        """
+        Embed several search queries, encoding only those not in the query LRU
+        (in one batch). Texts differing only in whitespace — or in case, for an
+        uncased tokenizer — share one entry, since the model can't tell them
+        apart. Returned lists are shared with the cache — don't mutate.
+        """
+        texts = [" ".join(t.split()) for t in texts]
+        if self._lowercase:
+            texts = [t.lower() for t in texts]
+        with self._lock:
+            out    = [self._query_cache.get(t) for t in texts]
+            misses = list(dict.fromkeys(t for t, e in zip(texts, out) if e is None))
+            for t, e in zip(texts, out):
+                if e is not None:
+                    self._query_cache.move_to_end(t)
+        if misses:
+            fresh = dict(zip(misses, self.embed_batch(misses, batch_size=len(misses))))
+            with self._lock:
+                for t, e in fresh.items():
+                    self._query_cache[t] = e
+                while len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                    self._query_cache.popitem(last=False)
+            out = [e if e is not None else fresh[t] for t, e in zip(texts, out)]
+        return out
+
+    def embed_batch(self, texts: list, batch_size: int = 64, **kwargs) -> list:
+        """Embed a list of texts in forward passes of batch_size; returns list of float lists."""
+        vecs = self._model.encode(texts, batch_size=batch_size,
+                                  convert_to_numpy=True, show_progress_bar=False)
         return [v.tolist() for v in vecs]
 
 
+class CrossEncoderReranker:
+    """
+    Optional second-stage reranker: scores (query, passage) pairs jointly with a
+    sentence-transformers CrossEncoder. Used to re-order an oversampled vector
+    top-k before the best few passages go to Claude.
+    """
+
+    MODEL_NAME = "BAAI/bge-reranker-v2-m3"
+
+    def __init__(self, model_name: str = MODEL_NAME):
+        from sentence_transformers import CrossEncoder
+        self._model = CrossEncoder(model_name)
+
+    def rerank(self, query: str, chunks: list, top_k: int) -> list:
+        """Return the top_k chunks by cross-encoder score (stored as _rerank_score)."""
+        if not chunks:
+            return []
+        scores = self._model.predict([(query, c["text"]) for c in chunks],
+                                     show_progress_bar=False)
+        ranked = sorted(zip(scores, chunks), key=lambda x: x[0], reverse=True)
+        out = []
+        for score, chunk in ranked[:top_k]:
+            chunk = dict(chunk)
+            chunk["_rerank_score"] = round(float(score), 4)
+            out.append(chunk)
+        return out
+
+
 # ─────────────────────────────────────────────────────────
 # VECTOR STORE  (in-memory)
 # ─────────────────────────────────────────────────────────
 
 class InMemoryVectorStore:
-    """Lightweight in-memory vector store using cosine similarity."""
+    """
+    Lightweight in-memory vector store using cosine similarity.
+
+    Call build() once all chunks are added: when faiss is installed the
+    embeddings are L2-normalised into an inner-product index whose layout
+    depends on size — exact flat float32 for small stores, 8-bit scalar
+    quantised codes from SQ8_MIN_VECTORS, IVF-PQ from IVF_MIN_VECTORS
+    (quantize=False keeps full-precision vectors throughout, with an HNSW
+    graph instead of IVF lists from IVF_MIN_VECTORS). Without
+    faiss, build() keeps a row-normalised float32 matrix instead (int8 codes
+    from SQ8_MIN_VECTORS) and search is a single numpy matrix-vector product; the pure-Python cosine scan is
+    only used when numpy is missing too.
+    """
+
+    SQ8_MIN_VECTORS = 2_000    # int8 codes (4x smaller than float32) from this size
+    IVF_MIN_VECTORS = 10_000   # coarse IVF lists + PQ codes from this size
+    IVF_NPROBE      = 16
+    HNSW_M          = 32       # graph degree for the full-precision large-store layout
+    HNSW_EF_SEARCH  = 64
 
-    def __init__(self):
+    def __init__(self, quantize: bool = True):
+        self.quantize   = quantize
         self.documents  = []   # list of chunk dicts
         self.embeddings = []   # parallel list of embedding vectors
+        self._index     = None # faiss index over normalised embeddings (see build)
+        self._matrix    = None # numpy fallback: (n, d) row-normalised float32, or int8 codes
+        self._scales    = None # per-row dequantisation scales when _matrix is int8
+        self._section_masks = {}   # section -> boolean row mask, built on first filtered search
 
     def add(self, chunk: dict, embedding: list):
         self.documents.append(chunk)
         self.embeddings.append(embedding)
+        self._index  = None    # stale until the next build()
+        self._matrix = self._scales = None
+        self._section_masks = {}
+
+    def build(self, index_path: Optional[str] = None) -> bool:
+        """
+        Compile the stored embeddings into a FAISS index. Returns False if faiss is unavailable.
+        Trained layouts (SQ8, IVF, HNSW) are read from / written to index_path when given,
+        so a restart with the same embeddings skips training.
+        """
+        self._index = self._matrix = self._scales = None
+        try:
+            import numpy as np
+        except ImportError:
+            return False
+        if not self.embeddings:
+            return False
+        try:
+            import faiss
+        except ImportError:
+            self._build_matrix(np)
+            return False
+
+        vecs = np.array(self.embeddings, dtype=np.float32)
+        faiss.normalize_L2(vecs)
+        n, dim = vecs.shape
+
+        trained = n >= self.IVF_MIN_VECTORS or (self.quantize and n >= self.SQ8_MIN_VECTORS)
+        if trained and index_path:
+            index = self._read_index(faiss, index_path, n, dim)
+            if index is not None:
+                self._index = index
+                return True
+
+        if n >= self.IVF_MIN_VECTORS and self.quantize:
+            nlist     = min(4096, int(4 * math.sqrt(n)))
+            quantizer = faiss.IndexFlatIP(dim)
+            m         = next(m for m in (64, 48, 32, 24, 16, 8, 4, 2, 1) if dim % m == 0)
+            index     = faiss.IndexIVFPQ(quantizer, dim, nlist, m, 8, faiss.METRIC_INNER_PRODUCT)
+            index.train(vecs)
+            index.nprobe = self.IVF_NPROBE
+        elif n >= self.IVF_MIN_VECTORS:
+            # Full-precision vectors: a graph gives better recall per probe than IVF lists
+            index = faiss.IndexHNSWFlat(dim, self.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = 200
+            index.hnsw.efSearch       = self.HNSW_EF_SEARCH
+        elif self.quantize and n >= self.SQ8_MIN_VECTORS:
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit,
+                                               faiss.METRIC_INNER_PRODUCT)
+            index.train(vecs)
+        else:
+            index = faiss.IndexFlatIP(dim)
+        index.add(vecs)
+        self._index = index
+        if trained and index_path:
+            self._write_index(faiss, index, index_path)
+        return True
+
+    def _read_index(self, faiss, path: str, n: int, dim: int):
+        if not os.path.exists(path):
+            return None
+        try:
+            index = faiss.read_index(path)
+        except RuntimeError:
+            return None
+        if index.ntotal != n or index.d != dim:
+            return None
+        if hasattr(index, "nprobe"):
+            index.nprobe = self.IVF_NPROBE
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = self.HNSW_EF_SEARCH
+        return index
+
+    @staticmethod
+    def _write_index(faiss, index, path: str) -> None:
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            faiss.write_index(index, tmp_path)
+            os.replace(tmp_path, path)
+        except (RuntimeError, OSError):
+            pass   # read-only deployments simply retrain on the next cold start
+
+    def _build_matrix(self, np) -> None:
+        """
+        Pre-normalise the corpus once so cosine scoring is a plain dot product.
+        From SQ8_MIN_VECTORS (and quantize=True) rows are stored as symmetric
+        int8 codes with a per-row scale, mirroring the faiss SQ8 tier.
+        """
+        mat   = np.array(self.embeddings, dtype=np.float32)
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        mat  /= norms
+        if self.quantize and len(mat) >= self.SQ8_MIN_VECTORS:
+            scales = np.abs(mat).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self._matrix = np.ascontiguousarray(np.round(mat / scales[:, None]).astype(np.int8))
+            self._scales = scales.astype(np.float32)
+        else:
+            self._matrix = np.ascontiguousarray(mat)
+
+    def _matrix_scores(self, q):
+        """Cosine scores of normalised query rows q (N, d) against the corpus → (N, n)."""
+        import numpy as np
+
+        if self._scales is None:
+            return q @ self._matrix.T
+        q_scale = np.abs(q).max(axis=1, keepdims=True) / 127.0
+        q_scale[q_scale == 0] = 1.0
+        q_i8 = np.round(q / q_scale).astype(np.int32)
+        raw  = q_i8 @ self._matrix.T.astype(np.int32)
+        return raw.astype(np.float32) * self._scales * q_scale
 
     def search(self, query_embedding: list, top_k: int = 5,
                section_filter: Optional[str] = None) -> list:
         """Return top_k chunks ranked by cosine similarity."""
+        if self._index is not None:
+            return self._search_faiss(query_embedding, top_k, section_filter)
+        if self._matrix is not None:
+            return self._search_matrix(query_embedding, top_k, section_filter)
+
         scored = []
         for idx, emb in enumerate(self.embeddings):
             doc = self.documents[idx]
@@ -95,14 +340,95 @@ class InMemoryVectorStore:
                 continue
             scored.append((cosine_similarity(query_embedding, emb), idx))
 
-        scored.sort(key=lambda x: x[0], reverse=True)
+        # Same order as a full stable sort, but O(n log k)
+        top = heapq.nlargest(top_k, scored, key=lambda x: x[0])
+        return [self._result(idx, score) for score, idx in top]
+
+    def search_many(self, query_embeddings: list, top_k: int = 5) -> list:
+        """
+        Top_k chunks for each of several queries. With a FAISS index the whole
+        (N, d) query matrix is scored in one index.search call.
+        """
+        if self._index is None and self._matrix is not None:
+            import numpy as np
+
+            q = np.array(query_embeddings, dtype=np.float32)
+            q /= np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+            scores = self._matrix_scores(q)      # (N, n) in one GEMM
+            k   = min(top_k, scores.shape[1])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+            top   = np.take_along_axis(top, order, axis=1)
+            return [[self._result(int(i), float(row[i])) for i in ids]
+                    for row, ids in zip(scores, top)]
+        if self._index is None:
+            return [self.search(q, top_k=top_k) for q in query_embeddings]
+
+        import faiss
+        import numpy as np
+
+        q = np.array(query_embeddings, dtype=np.float32)
+        faiss.normalize_L2(q)
+        scores, ids = self._index.search(q, min(top_k, self._index.ntotal))
+        return [
+            [self._result(int(i), float(sc)) for sc, i in zip(row_s, row_i) if i >= 0]
+            for row_s, row_i in zip(scores, ids)
+        ]
+
+    def _search_faiss(self, query_embedding: list, top_k: int,
+                      section_filter: Optional[str]) -> list:
+        import faiss
+        import numpy as np
+
+        q = np.array(query_embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(q)
+        # With a section filter, over-fetch everything and filter afterwards
+        k = self._index.ntotal if section_filter else min(top_k, self._index.ntotal)
+        scores, ids = self._index.search(q, k)
+
+        keep    = self._section_mask(section_filter) if section_filter else None
         results = []
-        for score, idx in scored[:top_k]:
-            chunk = self.documents[idx].copy()
-            chunk["_score"] = round(score, 4)
-            results.append(chunk)
+        for score, idx in zip(scores[0], ids[0]):
+            if idx < 0:
+                continue
+            if keep is not None and not keep[idx]:
+                continue
+            results.append(self._result(int(idx), float(score)))
+            if len(results) == top_k:
+                break
         return results
 
+    def _search_matrix(self, query_embedding: list, top_k: int,
+                       section_filter: Optional[str]) -> list:
+        import numpy as np
+
+        q    = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm == 0:
+            return []
+        scores = self._matrix_scores((q / norm)[None, :])[0]
+        if section_filter:
+            scores = np.where(self._section_mask(section_filter), scores, -np.inf)
+        k = min(top_k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self._result(int(i), float(scores[i])) for i in top if scores[i] != -np.inf]
+
+    def _section_mask(self, section: str):
+        import numpy as np
+        mask = self._section_masks.get(section)
+        if mask is None:
+            mask = np.array([d.get("section") == section for d in self.documents], dtype=bool)
+            self._section_masks[section] = mask
+        return mask
+
+    def _result(self, idx: int, score: float) -> dict:
+        chunk = self.documents[idx].copy()
+        chunk["_score"] = round(score, 4)
+        return chunk
+
     def __len__(self):
         return len(self.documents)
 
@@ -111,34 +437,80 @@ class InMemoryVectorStore:
 # RAG ENGINE
 # ─────────────────────────────────────────────────────────
 
+# Static generation instructions, sent as the system block.
+RAG_SYSTEM_PROMPT = """You are an expert clinical hematologist with deep knowledge of CBC \
+interpretation per UpToDate guidelines.
+
+Use ONLY the retrieved knowledge passages in the user message to answer the clinical question. \
+Cite each source as [Source N] inline. If the passages do not contain enough information, \
+clearly state this.
+
+INSTRUCTIONS:
+- Answer with clinical precision grounded only in the provided passages
+- Use [Source N] citations inline for every clinical claim
+- Structure your answer: Clinical Finding | Interpretation | Differential Diagnosis | Recommended Next Steps
+- Be specific about cutoff values, mechanisms, and test recommendations
+- End with a "Key References Used" list
+"""
+
+# Sex-specific haemoglobin reference interval (g/dL) used to gate the analyses
+HGB_RANGE = {"M": (13.5, 17.5), "F": (12.0, 15.5)}
+
 class CBCRagEngine:
     """
     Main RAG engine for CBC clinical analysis.
 
     Workflow:
-      1. Build index (local sentence-transformers embeddings — no API key)
+      1. Build index (local sentence-transformers embeddings — no API key;
+         chunk embeddings, and trained FAISS indexes, are persisted to cache_dir and
+         reused while the KB is unchanged)
       2. For each clinical query: embed query → cosine search → augment prompt → Claude generates
     """
 
     DEFAULT_GEN_MODEL = "claude-3-5-haiku-20241022"
+    EMBED_BATCH_SIZE  = 64   # chunks per embed_batch call during build_index
 
     def __init__(self, kb_path: str,
                  api_key: Optional[str] = None,
-                 gen_model: str = DEFAULT_GEN_MODEL):
-        self.kb_path    = kb_path
-        self.api_key    = api_key
-        self.gen_model  = gen_model
-        self.embedder   = SentenceTransformerEmbedder()
-        self.store      = InMemoryVectorStore()
-        self.chunks     = load_knowledge_base(kb_path)
-        self._ready     = False
+                 gen_model: str = DEFAULT_GEN_MODEL,
+                 chunks: Optional[list] = None,
+                 cache_dir: Optional[str] = None):
+        self.kb_path     = kb_path
+        self.api_key     = api_key
+        self.gen_model   = gen_model
+        self.embed_model = SentenceTransformerEmbedder.MODEL_NAME
+        self.cache_dir   = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(kb_path))
+        self.store       = InMemoryVectorStore()
+        self.chunks      = chunks if chunks is not None else load_knowledge_base(kb_path)
+        self._embedder   = None
+        self._ready      = False
+        self._client     = None    # sync Anthropic client, created on first generation
+
+    @property
+    def embedder(self) -> SentenceTransformerEmbedder:
+        """Model is loaded on first use, so a warm index build never touches it."""
+        if self._embedder is None:
+            self._embedder = SentenceTransformerEmbedder(self.embed_model)
+        return self._embedder
+
+    @property
+    def client(self):
+        """
+        Anthropic client for this engine's api_key, kept so its HTTP connection
+        pool (and TLS sessions) is reused across generations.
+        """
+        if self._client is None or self._client.api_key != self.api_key:
+            import anthropic
+            self._client = anthropic.Anthropic(api_key=self.api_key)
+        return self._client
 
     # ── INDEX BUILDING  (local, no API key) ──────────────
 
     def build_index(self, progress_callback=None) -> int:
         """
-        Embed all chunks with local sentence-transformers.
-        progress_callback(i, total) called after each chunk.
+        Embed all chunks with local sentence-transformers, or memory-map the
+        embeddings persisted by a previous build of the same KB + model.
+        progress_callback(i, total) called after each embedded batch.
         Returns number of chunks indexed.
         """
         total = len(self.chunks)
@@ -153,12 +525,31 @@ class CBCRagEngine:
                 f"{chunk['text']}"
             )
 
-        embeddings = self.embedder.embed_batch(texts)
-
-        for i, (chunk, emb) in enumerate(zip(self.chunks, embeddings)):
+        cache_path = self._embedding_cache_path(texts)
+        embeddings = self._load_cached_embeddings(cache_path, len(texts))
+        if embeddings is None:
+            # A KB edit only re-embeds the chunks whose text changed
+            row_keys   = self._row_keys(texts)
+            embeddings = self._reusable_embeddings(row_keys)
+            missing    = [i for i, e in enumerate(embeddings) if e is None]
+            done       = total - len(missing)
+            for start in range(0, len(missing), self.EMBED_BATCH_SIZE):
+                rows  = missing[start:start + self.EMBED_BATCH_SIZE]
+                batch = [texts[i] for i in rows]
+                for i, emb in zip(rows, self.embedder.embed_batch(batch, batch_size=len(batch))):
+                    embeddings[i] = emb
+                done += len(rows)
+                if progress_callback:
+                    progress_callback(done, total)
+            if not missing and progress_callback:
+                progress_callback(total, total)
+            self._save_cached_embeddings(cache_path, embeddings, row_keys)
+        elif progress_callback:
+            progress_callback(total, total)
+
+        for chunk, emb in zip(self.chunks, embeddings):
             self.store.add(chunk, emb)
-            if progress_callback:
-                progress_callback(i + 1, total)
+        self.store.build(index_path=self._index_cache_path(cache_path))
 
         self._ready = True
         return total
@@ -166,6 +557,126 @@ class CBCRagEngine:
     def is_ready(self) -> bool:
         return self._ready
 
+    # ── EMBEDDING CACHE  (disk, keyed by model + chunk texts) ──
+
+    def _model_key(self) -> str:
+        # Quantised and full-precision vectors must never be mixed in one index
+        model_key = self.embed_model
+        if SentenceTransformerEmbedder.BACKEND != "torch":
+            model_key += f":{SentenceTransformerEmbedder.BACKEND}"
+        return model_key
+
+    def _embedding_cache_path(self, texts: list) -> Optional[str]:
+        if not self.cache_dir:
+            return None
+        h = hashlib.sha256(self._model_key().encode("utf-8"))
+        for text in texts:
+            h.update(b"\x00")
+            h.update(text.encode("utf-8"))
+        return os.path.join(self.cache_dir, f"embeddings_{h.hexdigest()[:16]}.npy")
+
+    def _index_cache_path(self, embedding_cache_path: Optional[str]) -> Optional[str]:
+        """Trained FAISS index file next to (and keyed like) the embedding cache."""
+        if not embedding_cache_path:
+            return None
+        base = os.path.basename(embedding_cache_path)[len("embeddings_"):-len(".npy")]
+        kind = "q" if self.store.quantize else "f"
+        return os.path.join(os.path.dirname(embedding_cache_path), f"index_{base}_{kind}.faiss")
+
+    @staticmethod
+    def _load_cached_embeddings(path: Optional[str], expected_rows: int):
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            import numpy as np
+            embeddings = np.load(path, mmap_mode="r")
+        except (ImportError, OSError, ValueError):
+            return None
+        if embeddings.ndim != 2 or embeddings.shape[0] != expected_rows:
+            return None
+        return embeddings
+
+    @staticmethod
+    def _save_cached_embeddings(path: Optional[str], embeddings: list,
+                                row_keys: Optional[list] = None) -> None:
+        """Write the embeddings (and, when given, their per-row content keys) atomically."""
+        if not path:
+            return
+        try:
+            import numpy as np
+            files = [(path, np.asarray(embeddings, dtype=np.float32))]
+            if row_keys is not None:
+                files.append((path[:-len(".npy")] + ".keys.npy", np.frombuffer(b"".join(row_keys), dtype=np.uint8).reshape(-1, 16)))
+            # Keys last: a keys file only ever sits next to a complete matrix
+            for target, array in files:
+                tmp_path = f"{target}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp_path, target)
+        except (ImportError, OSError):
+            return   # read-only deployments simply re-embed on the next cold start
+        CBCRagEngine._prune_cache(path)
+
+    @staticmethod
+    def _prune_cache(keep_path: str) -> None:
+        """Delete the embeddings, keys and index files of builds superseded by keep_path."""
+        cache_dir = os.path.dirname(keep_path)
+        base      = os.path.basename(keep_path)[len("embeddings_"):-len(".npy")]
+        try:
+            names = os.listdir(cache_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith(("embeddings_", "index_")) or base in name or name.endswith(".tmp"):
+                continue
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass   # still mapped elsewhere (Windows) — the next save retries
+
+    def _row_keys(self, texts: list) -> list:
+        """Per-chunk content keys: sha256(model, text), truncated to 16 bytes."""
+        model = self._model_key().encode("utf-8") + b"\x00"
+        return [hashlib.sha256(model + t.encode("utf-8")).digest()[:16] for t in texts]
+
+    def _reusable_embeddings(self, row_keys: list) -> list:
+        """
+        Vectors for rows whose text is unchanged since a cached build (matched
+        by content key, from the build sharing the most rows); None for rows
+        that must be embedded.
+        """
+        reused = [None] * len(row_keys)
+        if not self.cache_dir:
+            return reused
+        try:
+            import numpy as np
+            wanted = set(row_keys)
+            donor, donor_keys, overlap = None, None, 0
+            for name in os.listdir(self.cache_dir):
+                if not (name.startswith("embeddings_") and name.endswith(".keys.npy")):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                keys = np.load(path)
+                if keys.ndim != 2 or keys.shape[1] != 16:
+                    continue
+                raw = keys.tobytes()
+                n   = sum(raw[16 * i:16 * (i + 1)] in wanted for i in range(len(keys)))
+                if n > overlap:
+                    donor, donor_keys, overlap = path, raw, n
+            if donor is None:
+                return reused
+            vecs = np.load(donor[:-len(".keys.npy")] + ".npy", mmap_mode="r")
+        except (ImportError, OSError, ValueError):
+            return reused
+        if vecs.ndim != 2 or len(donor_keys) != 16 * len(vecs):
+            return reused
+        row_of = {donor_keys[16 * i:16 * (i + 1)]: i for i in range(len(vecs))}
+        for i, key in enumerate(row_keys):
+            j = row_of.get(key)
+            if j is not None:
+                reused[i] = np.array(vecs[j], dtype=np.float32)   # copy: the donor is pruned after the save
+        return reused
+
     # ── RETRIEVAL ─────────────────────────────────────────
 
     def retrieve(self, query: str, top_k: int = 4,
@@ -176,6 +687,15 @@ class CBCRagEngine:
         q_emb = self.embedder.embed_query(query)
         return self.store.search(q_emb, top_k=top_k, section_filter=section_filter)
 
+    def retrieve_many(self, queries: list, top_k: int = 4) -> list:
+        """Retrieve top_k chunks for each query: one batched embed (cache misses only), one batched search."""
+        if not self._ready:
+            raise RuntimeError("Index not built. Call build_index() first.")
+        if not queries:
+            return []
+        q_embs = self.embedder.embed_queries(queries)
+        return self.store.search_many(q_embs, top_k=top_k)
+
     def format_context(self, chunks: list) -> str:
         """Format retrieved chunks as a context block for the prompt."""
         parts = []
@@ -188,62 +708,48 @@ class CBCRagEngine:
 
     # ── GENERATE WITH RAG  (Claude API) ──────────────────
 
-    def generate_with_rag(self, query: str, top_k: int = 4,
-                          additional_context: str = "",
-                          temperature: float = 0.2) -> dict:
+    def _build_rag_request(self, query: str, top_k: int, additional_context: str,
+                           temperature: float, retrieved: Optional[list] = None,
+                           reranker: Optional[CrossEncoderReranker] = None,
+                           oversample: int = 8) -> tuple:
         """
-        Full RAG pipeline: retrieve → augment prompt → Claude generates.
-        Returns dict: {answer, sources, retrieved_chunks, query}
+        Retrieve → augment prompt. Pass retrieved to reuse chunks fetched by
+        retrieve_many; with a reranker, top_k*oversample candidates are
+        retrieved and the reranker keeps the best top_k.
+        Returns (messages.create kwargs, retrieved chunks).
         """
-        if not self.api_key:
-            raise ValueError("Anthropic API key required for generation.")
-
-        import anthropic
-
         # 1. Retrieve relevant chunks
-        retrieved   = self.retrieve(query, top_k=top_k)
+        if retrieved is None and reranker is not None:
+            candidates = self.retrieve(query, top_k=top_k * oversample)
+            retrieved  = reranker.rerank(query, candidates, top_k)
+        elif retrieved is None:
+            retrieved = self.retrieve(query, top_k=top_k)
         context_str = self.format_context(retrieved)
 
-        # 2. Build augmented prompt
+        # 2. Build augmented prompt: static instructions → passages → question.
+        #    No cache_control: even instructions + passages stay below the
+        #    model's minimum cacheable prompt length, where breakpoints are
+        #    ignored. The static-first order keeps a future cacheable prefix
+        #    a one-line change.
         extra = (
             f"ADDITIONAL PATIENT CONTEXT:\n{additional_context}\n\n"
             if additional_context else ""
         )
-        prompt = f"""You are an expert clinical hematologist with deep knowledge of CBC \
-interpretation per UpToDate guidelines.
-
-Use ONLY the following retrieved knowledge passages to answer the clinical question. \
-Cite each source as [Source N] inline. If the passages do not contain enough information, \
-clearly state this.
-
-────────────────────────────────────────
-RETRIEVED KNOWLEDGE PASSAGES:
-{context_str}
-────────────────────────────────────────
-
-{extra}CLINICAL QUESTION:
-{query}
-
-────────────────────────────────────────
-INSTRUCTIONS:
-- Answer with clinical precision grounded only in the provided passages
-- Use [Source N] citations inline for every clinical claim
-- Structure your answer: Clinical Finding | Interpretation | Differential Diagnosis | Recommended Next Steps
-- Be specific about cutoff values, mechanisms, and test recommendations
-- End with a "Key References Used" list
-"""
-
-        # 3. Generate with Claude
-        client  = anthropic.Anthropic(api_key=self.api_key)
-        message = client.messages.create(
+        request = dict(
             model=self.gen_model,
             max_tokens=1500,
             temperature=temperature,
-            messages=[{"role": "user", "content": prompt}]
+            system=[{"type": "text", "text": RAG_SYSTEM_PROMPT}],
+            messages=[{"role": "user", "content": [
+                {"type": "text", "text": f"RETRIEVED KNOWLEDGE PASSAGES:\n{context_str}"},
+                {"type": "text", "text": f"{extra}CLINICAL QUESTION:\n{query}"},
+            ]}],
         )
-        answer = message.content[0].text
+        return request, retrieved
 
-        # 4. Build source attribution list
+    @staticmethod
+    def _rag_result(answer: str, retrieved: list, query: str) -> dict:
+        """Attach the source attribution list to a generated answer."""
         sources = [
             {
                 "index":   i + 1,
@@ -262,14 +768,67 @@ INSTRUCTIONS:
             "query":            query,
         }
 
+    def generate_with_rag(self, query: str, top_k: int = 4,
+                          additional_context: str = "",
+                          temperature: float = 0.2,
+                          on_text: Optional[Callable[[str], None]] = None,
+                          reranker: Optional[CrossEncoderReranker] = None,
+                          oversample: int = 8) -> dict:
+        """
+        Full RAG pipeline: retrieve → (optional rerank) → augment prompt → Claude generates.
+        If on_text is given the answer is streamed and on_text(answer_so_far)
+        is called as each text delta arrives.
+        Returns dict: {answer, sources, retrieved_chunks, query}
+        """
+        if not self.api_key:
+            raise ValueError("Anthropic API key required for generation.")
+
+        request, retrieved = self._build_rag_request(query, top_k, additional_context, temperature,
+                                                     reranker=reranker, oversample=oversample)
+
+        # 3. Generate with Claude
+        client = self.client
+        if on_text is None:
+            answer = client.messages.create(**request).content[0].text
+        else:
+            parts = []
+            with client.messages.stream(**request) as stream:
+                for delta in stream.text_stream:
+                    parts.append(delta)
+                    on_text("".join(parts))
+            answer = "".join(parts)
+
+        return self._rag_result(answer, retrieved, query)
+
+    async def agenerate_with_rag(self, client, query: str, top_k: int = 4,
+                                 additional_context: str = "",
+                                 temperature: float = 0.2,
+                                 retrieved: Optional[list] = None,
+                                 on_text: Optional[Callable[[str], None]] = None) -> dict:
+        """generate_with_rag on a shared anthropic.AsyncAnthropic client."""
+        request, retrieved = self._build_rag_request(query, top_k, additional_context,
+                                                     temperature, retrieved)
+        if on_text is None:
+            message = await client.messages.create(**request)
+            return self._rag_result(message.content[0].text, retrieved, query)
+        parts = []
+        async with client.messages.stream(**request) as stream:
+            async for delta in stream.text_stream:
+                parts.append(delta)
+                on_text("".join(parts))
+        return self._rag_result("".join(parts), retrieved, query)
+
     # ── TARGETED ANALYSIS METHODS ─────────────────────────
+    # Each _*_request builds the generate_with_rag kwargs for one clinical
+    # section (None when the section is normal); analyze_* runs it serially and
+    # analyze_many runs several concurrently.
 
-    def analyze_anemia(self, cbc_values: dict, sex: str) -> Optional[dict]:
+    def _anemia_request(self, cbc_values: dict, sex: str) -> Optional[dict]:
         hgb    = cbc_values.get("hgb")
         mcv    = cbc_values.get("mcv")
         rdw    = cbc_values.get("rdw")
         retic  = cbc_values.get("retic")
-        hgb_lo = 13.5 if sex == "M" else 12.0
+        hgb_lo = HGB_RANGE[sex][0]
 
         if hgb is None or hgb >= hgb_lo:
             return None
@@ -281,12 +840,12 @@ INSTRUCTIONS:
             "causes, explain pathophysiology, and recommend specific next investigations. "
             "What does the RDW indicate? What is the reticulocyte production index?"
         )
-        return self.generate_with_rag(
+        return dict(
             query=query, top_k=5,
-            additional_context=f"CBC: {json.dumps({k:v for k,v in cbc_values.items() if v})}",
+            additional_context=f"CBC: {cbc_json(cbc_values)}",
         )
 
-    def analyze_neutrophil_abnormality(self, cbc_values: dict) -> Optional[dict]:
+    def _neutrophil_request(self, cbc_values: dict) -> Optional[dict]:
         wbc      = cbc_values.get("wbc")
         neut_abs = cbc_values.get("neut_abs")
         neut_pct = cbc_values.get("neut_pct")
@@ -316,12 +875,12 @@ INSTRUCTIONS:
         else:
             return None
 
-        return self.generate_with_rag(
+        return dict(
             query=query, top_k=4,
-            additional_context=f"CBC: {json.dumps({k:v for k,v in cbc_values.items() if v})}",
+            additional_context=f"CBC: {cbc_json(cbc_values)}",
         )
 
-    def analyze_platelet_abnormality(self, cbc_values: dict) -> Optional[dict]:
+    def _platelet_request(self, cbc_values: dict) -> Optional[dict]:
         plt = cbc_values.get("plt")
         mpv = cbc_values.get("mpv")
 
@@ -343,12 +902,12 @@ INSTRUCTIONS:
         else:
             return None
 
-        return self.generate_with_rag(
+        return dict(
             query=query, top_k=4,
-            additional_context=f"CBC: {json.dumps({k:v for k,v in cbc_values.items() if v})}",
+            additional_context=f"CBC: {cbc_json(cbc_values)}",
         )
 
-    def analyze_immunodeficiency_risk(self, cbc_values: dict, sex: str, age: int) -> dict:
+    def _immunodeficiency_request(self, cbc_values: dict, sex: str, age: int) -> dict:
         lymph_abs = cbc_values.get("lymph_abs")
         lymph_pct = cbc_values.get("lymph_pct")
         wbc       = cbc_values.get("wbc")
@@ -367,17 +926,101 @@ INSTRUCTIONS:
             "Red flags for this patient? Which conditions to rule out first? "
             "Stepwise evaluation including flow cytometry and immunoglobulin testing."
         )
-        return self.generate_with_rag(
+        return dict(
             query=query, top_k=4,
-            additional_context=f"Sex:{sex}, age:{age}. CBC: {json.dumps({k:v for k,v in cbc_values.items() if v})}",
+            additional_context=f"Sex:{sex}, age:{age}. CBC: {cbc_json(cbc_values)}",
         )
 
+    def _polycythemia_request(self, cbc_values: dict, sex: str) -> Optional[dict]:
+        hgb    = cbc_values.get("hgb")
+        hgb_hi = HGB_RANGE[sex][1]
+
+        if hgb is None or hgb <= hgb_hi:
+            return None
+
+        return dict(
+            query=f"Patient has erythrocytosis: Hgb {hgb} g/dL ({sex}). Classify and provide workup.",
+            top_k=3,
+            additional_context=f"Sex:{sex}, CBC: {cbc_json(cbc_values)}",
+        )
+
+    def analyze_anemia(self, cbc_values: dict, sex: str) -> Optional[dict]:
+        request = self._anemia_request(cbc_values, sex)
+        return self.generate_with_rag(**request) if request else None
+
+    def analyze_neutrophil_abnormality(self, cbc_values: dict) -> Optional[dict]:
+        request = self._neutrophil_request(cbc_values)
+        return self.generate_with_rag(**request) if request else None
+
+    def analyze_platelet_abnormality(self, cbc_values: dict) -> Optional[dict]:
+        request = self._platelet_request(cbc_values)
+        return self.generate_with_rag(**request) if request else None
+
+    def analyze_immunodeficiency_risk(self, cbc_values: dict, sex: str, age: int) -> dict:
+        return self.generate_with_rag(**self._immunodeficiency_request(cbc_values, sex, age))
+
+    def analyze_polycythemia(self, cbc_values: dict, sex: str) -> Optional[dict]:
+        request = self._polycythemia_request(cbc_values, sex)
+        return self.generate_with_rag(**request) if request else None
+
+    def analyze_many(self, cbc_values: dict, sex: str, age: int,
+                     sections=("anemia", "neutrophil", "platelets"),
+                     on_text: Optional[Callable[[str, str], None]] = None) -> dict:
+        """
+        Runs several targeted analyses with one batched retrieval, then generates
+        concurrently over one AsyncAnthropic client, so total latency is the
+        slowest section rather than the sum.
+        If on_text is given every answer is streamed and on_text(section,
+        answer_so_far) is called on the calling thread as each delta arrives.
+        Returns {section: result dict | None | Exception}; per-section failures
+        are returned in place rather than raised.
+        """
+        if not self.api_key:
+            raise ValueError("Anthropic API key required for generation.")
+
+        import asyncio
+        import anthropic
+
+        builders = {
+            "anemia":           lambda: self._anemia_request(cbc_values, sex),
+            "neutrophil":       lambda: self._neutrophil_request(cbc_values),
+            "platelets":        lambda: self._platelet_request(cbc_values),
+            "immunodeficiency": lambda: self._immunodeficiency_request(cbc_values, sex, age),
+            "polycythemia":     lambda: self._polycythemia_request(cbc_values, sex),
+            "full":             lambda: self._full_request(cbc_values, sex, age),
+        }
+        requests = {s: builders[s]() for s in sections}
+
+        # One batched embed + search for every section that needs an answer,
+        # each sliced back to its own top_k.
+        active = [r for r in requests.values() if r is not None]
+        hits   = self.retrieve_many([r["query"] for r in active],
+                                    top_k=max((r["top_k"] for r in active), default=0))
+        for r, chunks in zip(active, hits):
+            r["retrieved"] = chunks[:r["top_k"]]
+
+        async def _run():
+            async with anthropic.AsyncAnthropic(api_key=self.api_key) as client:
+                async def _one(section, request):
+                    if request is None:
+                        return None
+                    stream_to = None if on_text is None else functools.partial(on_text, section)
+                    return await self.agenerate_with_rag(client, **request, on_text=stream_to)
+                results = await asyncio.gather(
+                    *(_one(s, r) for s, r in requests.items()), return_exceptions=True
+                )
+            return dict(zip(requests, results))
+
+        return asyncio.run(_run())
+
     def full_rag_analysis(self, cbc_values: dict, sex: str, age: int) -> dict:
         """Comprehensive RAG-based clinical narrative for all abnormalities."""
+        return self.generate_with_rag(**self._full_request(cbc_values, sex, age))
+
+    def _full_request(self, cbc_values: dict, sex: str, age: int) -> dict:
         entered = {k: v for k, v in cbc_values.items() if v is not None and v > 0}
 
-        hgb_lo = 13.5 if sex == "M" else 12.0
-        hgb_hi = 17.5 if sex == "M" else 15.5
+        hgb_lo, hgb_hi = HGB_RANGE[sex]
         abnormals = []
 
         hgb = cbc_values.get("hgb")
@@ -425,45 +1068,158 @@ INSTRUCTIONS:
             "5. SEQUENTIAL INVESTIGATION PLAN: step-by-step with rationale\n"
             "6. COLLECTION QUALITY: any internal inconsistencies suggesting pre-analytical error"
         )
-        return self.generate_with_rag(
+        return dict(
             query=query, top_k=6,
             additional_context=f"Sex:{sex}, age:{age}. Abnormalities: {abnormals}",
         )
 
 
+# ─────────────────────────────────────────────────────────
+# SEMANTIC ANSWER CACHE  (in-memory, shared across sessions)
+# ─────────────────────────────────────────────────────────
+
+class SemanticQueryCache:
+    """
+    Caches RAG answers by query meaning rather than exact text.
+    A lookup hits when a stored query embedding has cosine similarity
+    >= threshold with the new one AND the additional context is identical,
+    so the same question about a different CBC is never served a stale answer.
+    Entries are bucketed by context and stored L2-normalised, so a lookup is
+    one matrix-vector product over that context's entries only.
+    LRU-evicts beyond max_entries; entries older than ttl_seconds expire on read.
+    """
+
+    def __init__(self, threshold: float = 0.92, max_entries: int = 128,
+                 ttl_seconds: float = 7 * 24 * 3600):
+        self.threshold   = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries    = OrderedDict()   # (query, context) -> (unit embedding, result, stored_at)
+        self._by_context = {}              # context -> {query: None} (insertion-ordered set)
+        self._lock       = threading.Lock()
+
+    @staticmethod
+    def _unit(embedding):
+        import numpy as np
+        v    = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def _drop(self, key) -> None:
+        del self._entries[key]
+        bucket = self._by_context[key[1]]
+        del bucket[key[0]]
+        if not bucket:
+            del self._by_context[key[1]]
+
+    def lookup(self, query_embedding: list, context: str = "") -> Optional[dict]:
+        """Return the cached result for the closest matching query, or None."""
+        import numpy as np
+
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (_, _, ts) in self._entries.items() if now - ts > self.ttl_seconds]
+            for k in expired:
+                self._drop(k)
+
+            bucket = self._by_context.get(context)
+            if not bucket:
+                return None
+            keys = [(q, context) for q in bucket]
+            sims = np.stack([self._entries[k][0] for k in keys]) @ self._unit(query_embedding)
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            self._entries.move_to_end(keys[best])
+            return self._entries[keys[best]][1]
+
+    def store(self, query: str, query_embedding: list, context: str, result: dict) -> None:
+        key = (query, context)
+        with self._lock:
+            self._entries[key] = (self._unit(query_embedding), result, time.time())
+            self._entries.move_to_end(key)
+            self._by_context.setdefault(context, {})[query] = None
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+
 # ─────────────────────────────────────────────────────────
 # KEYWORD FALLBACK RETRIEVAL  (no API required)
 # ─────────────────────────────────────────────────────────
 
+_TOKEN_RE = re.compile(r"\b\w+\b")
+
+
 class KeywordRetriever:
     """
     TF-IDF-style keyword overlap retriever.
     Used when knowledge index is not yet built.
+
+    The KB vocabulary is compiled once into an inverted index stored as
+    flat arrays (CSR layout): token → row, and row → a slice of
+    _doc_ids. A query is one tokenisation, a few slice gathers and a
+    single np.bincount, instead of re-tokenising every chunk.
     """
 
     def __init__(self, chunks: list):
-        self.chunks = chunks
+        import numpy as np
 
-    def _score(self, chunk: dict, query_tokens: set) -> float:
+        self.chunks = chunks
+        postings    = {}     # token -> list of chunk indices containing it
+        norms       = []     # sqrt(#distinct tokens) per chunk
+        for idx, chunk in enumerate(chunks):
+            tokens = self._chunk_tokens(chunk)
+            norms.append(math.sqrt(len(tokens)))
+            for token in tokens:
+                postings.setdefault(token, []).append(idx)
+
+        self._term2row = {token: row for row, token in enumerate(postings)}
+        lens           = np.fromiter((len(p) for p in postings.values()), dtype=np.int64,
+                                     count=len(postings))
+        self._offsets  = np.concatenate(([0], np.cumsum(lens)))
+        self._doc_ids  = np.fromiter((i for p in postings.values() for i in p), dtype=np.int32,
+                                     count=int(self._offsets[-1]))
+        norms          = np.array(norms, dtype=np.float64)
+        self._inv_norm = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+
+    @staticmethod
+    def _chunk_tokens(chunk: dict) -> set:
         chunk_text = (
             chunk["text"].lower() + " " +
             chunk.get("title", "").lower() + " " +
             " ".join(chunk.get("keywords", [])).lower()
         )
-        chunk_tokens = set(re.findall(r"\b\w+\b", chunk_text))
-        overlap = query_tokens & chunk_tokens
-        if not chunk_tokens:
-            return 0.0
-        return len(overlap) / math.sqrt(len(chunk_tokens))
+        return set(_TOKEN_RE.findall(chunk_text))
 
     def search(self, query: str, top_k: int = 4) -> list:
-        query_tokens = set(re.findall(r"\b\w+\b", query.lower()))
-        scored = [(self._score(c, query_tokens), c) for c in self.chunks]
-        scored.sort(key=lambda x: x[0], reverse=True)
+        import numpy as np
+
+        n    = len(self.chunks)
+        rows = [self._term2row[t] for t in set(_TOKEN_RE.findall(query.lower()))
+                if t in self._term2row]
+        if rows:
+            ids  = np.concatenate([self._doc_ids[self._offsets[r]:self._offsets[r + 1]]
+                                   for r in rows])
+            hits = np.bincount(ids, minlength=n)
+        else:
+            hits = np.zeros(n, dtype=np.int64)
+        scores = hits * self._inv_norm
+
+        k = min(top_k, n)
+        if k <= 0:
+            return []
+        # Everything scoring at least the k-th best, then (score desc, chunk order)
+        kth  = np.partition(scores, n - k)[n - k]
+        cand = np.flatnonzero(scores >= kth)
+        top  = cand[np.lexsort((cand, -scores[cand]))][:k]
+
         results = []
-        for score, chunk in scored[:top_k]:
-            c = chunk.copy()
-            c["_score"]  = round(score, 4)
+        for idx in top.tolist():
+            c = self.chunks[idx].copy()
+            c["_score"]  = round(float(scores[idx]), 4)
             c["_method"] = "keyword"
             results.append(c)
         return results
@@ -473,12 +1229,14 @@ class KeywordRetriever:
 # FACTORY HELPERS
 # ─────────────────────────────────────────────────────────
 
-def create_rag_engine(kb_path: str, api_key: Optional[str] = None) -> CBCRagEngine:
-    """Create and return a configured CBCRagEngine."""
-    return CBCRagEngine(kb_path=kb_path, api_key=api_key)
+def create_rag_engine(kb_path: str, api_key: Optional[str] = None,
+                      chunks: Optional[list] = None) -> CBCRagEngine:
+    """Create and return a configured CBCRagEngine (pass pre-loaded chunks to skip the JSON read)."""
+    return CBCRagEngine(kb_path=kb_path, api_key=api_key, chunks=chunks)
 
 
-def create_keyword_retriever(kb_path: str) -> KeywordRetriever:
-    """Create keyword-based fallback retriever."""
-    chunks = load_knowledge_base(kb_path)
+def create_keyword_retriever(kb_path: str, chunks: Optional[list] = None) -> KeywordRetriever:
+    """Create keyword-based fallback retriever (pass pre-loaded chunks to skip the JSON read)."""
+    if chunks is None:
+        chunks = load_knowledge_base(kb_path)
     return KeywordRetriever(chunks)